@@ -2,20 +2,92 @@ import os
 import sys
 
 from flask import Flask, render_template
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.json import JSONEncoder
 from flask.ext.mail import Mail
 from flask.ext.babel import Babel
+from sqlalchemy.orm import configure_mappers
+from .database import SQLAlchemy
 from .momentjs import momentjs
+from .mailqueue import MailQueue
+from .fragments import FragmentCache
+from .i18n import I18nCache
+from .profiling import RequestProfiler
+from .ratelimit import RateLimiter
 
 
-app = Flask(__name__)
-app.config.from_object('config')
-app.jinja_env.globals['momentjs'] = momentjs
+# the extensions are bound to an application by create_app()
+db = SQLAlchemy()
+mail = Mail()
+mail_queue = MailQueue()
+babel = Babel()
+i18n = I18nCache()
+fragment_cache = FragmentCache()
+profiler = RequestProfiler()
+limiter = RateLimiter()
+
+
+def create_app(config='config'):
+    """Build the application, configured from the ``config`` object (or
+    module name).
+
+    Nothing is connected or started here: the database connections and the
+    background threads are opened on first use, in the process using them,
+    so the application can be created before a server forks its workers.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.jinja_env.globals['momentjs'] = momentjs
+    profiler.init_app(app, db)
+
+    db.init_app(app)
+    mail.init_app(app)
+    mail_queue.init_app(app, mail)
+    babel.init_app(app)
+    i18n.init_app(app)
+    fragment_cache.init_app(app)
+    app.jinja_env.globals['render_post'] = fragment_cache.render_post
+    limiter.init_app(app)
+
+    if not app.config['DEBUG']:
+        install_secret_key(app)
+
+    app.register_error_handler(404, not_found)
+
+    from app.users.views import mod as usersModule
+    app.register_blueprint(usersModule)
+
+    from app.users.tracking import init_tracking
+    init_tracking(app)
+
+    from app.search import init_search
+    init_search(app)
+
+    from app.httpcache import init_http_cache
+    init_http_cache(app)
+
+    # Later on you'll import the other blueprints the same way:
+    #from app.comments.views import mod as commentsModule
+    #from app.posts.views import mod as postsModule
+    #app.register_blueprint(commentsModule)
+    #app.register_blueprint(postsModule)
+
+    app.json_encoder = CustomJSONEncoder
+    return app
+
+
+def warm_up(app):
+    """Do the work the first requests would otherwise pay for: compile the
+    templates, load the translations, configure the mappers and open a
+    database connection."""
+    with app.app_context():
+        # not the editors' hidden files
+        for name in app.jinja_env.list_templates(
+                filter_func=lambda name: not os.path.basename(name).startswith('.')):
+            app.jinja_env.get_template(name)
+        i18n.warm()
+        configure_mappers()
+        db.engine.connect().close()
 
-db = SQLAlchemy(app)
-mail = Mail(app)
-babel = Babel(app)
 
 ########################
 # Configure Secret Key #
@@ -40,22 +112,9 @@ def install_secret_key(app, filename='secret_key'):
         print('head -c 24 /dev/urandom > {filename}'.format(filename=filename))
         sys.exit(1)
 
-if not app.config['DEBUG']:
-    install_secret_key(app)
-
-@app.errorhandler(404)
 def not_found(error):
     return render_template('404.html'), 404
 
-from app.users.views import mod as usersModule
-app.register_blueprint(usersModule)
-
-# Later on you'll import the other blueprints the same way:
-#from app.comments.views import mod as commentsModule
-#from app.posts.views import mod as postsModule
-#app.register_blueprint(commentsModule)
-#app.register_blueprint(postsModule)
-
 class CustomJSONEncoder(JSONEncoder):
     """This class adds support for lazy translation texts to Flask's
     JSON encoder. This is necessary when flashing translated texts."""
@@ -67,5 +126,3 @@ class CustomJSONEncoder(JSONEncoder):
             except NameError:
                 return str(obj)  # python 3
         return super(CustomJSONEncoder, self).default(obj)
-
-app.json_encoder = CustomJSONEncoder
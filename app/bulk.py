@@ -0,0 +1,161 @@
+"""Bulk export and import of users, follows and posts as NDJSON.
+
+Every line is a JSON object ``{"table": ..., "row": {...}}``. Rows are
+read and written ``chunk_size`` at a time, so memory use does not grow with
+the size of the data, and imported with one executemany INSERT per chunk,
+committing every ``transaction_size`` rows.
+"""
+
+import json
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import select
+
+from app import db
+from app.search import get_backend
+from app.users.models import User, Post, followers
+
+TABLES = [User.__table__, followers, Post.__table__]
+CHUNK_SIZE = 1000
+TRANSACTION_SIZE = 50000
+
+
+class Report(object):
+    """Rows and seconds spent per table."""
+
+    def __init__(self):
+        self.rows = {}
+        self.seconds = {}
+        self.start = time.time()
+        self.end = None
+
+    def add(self, table, rows, seconds):
+        self.rows[table] = self.rows.get(table, 0) + rows
+        self.seconds[table] = self.seconds.get(table, 0.0) + seconds
+
+    def lines(self):
+        lines = [(t.name, self.rows[t.name], self.seconds[t.name])
+                 for t in TABLES if t.name in self.rows]
+        lines.append(('total', sum(self.rows.values()), (self.end or time.time()) - self.start))
+        for table, rows, seconds in lines:
+            yield '%s: %d rows in %.2fs (%d rows/s)' % (
+                table, rows, seconds, rows / seconds if seconds else 0)
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _decoder(table):
+    """A function turning a JSON row of ``table`` back into column values."""
+    dates = [column.name for column in table.columns if isinstance(column.type, db.DateTime)]
+
+    def decode(row):
+        for name in dates:
+            value = row.get(name)
+            if value is not None:
+                row[name] = datetime.strptime(
+                    value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value else '%Y-%m-%dT%H:%M:%S')
+        return row
+    return decode
+
+
+def export(output, tables=None, chunk_size=CHUNK_SIZE, engine=None):
+    """Write the rows of ``tables`` (names, all of them by default) to the
+    file ``output``, return a :class:`Report`."""
+    report = Report()
+    engine = engine or db.engine
+    with engine.connect() as connection:
+        for table in TABLES:
+            if tables and table.name not in tables:
+                continue
+            start = time.time()
+            count = 0
+            result = connection.execution_options(stream_results=True).execute(
+                select([table]).order_by(*table.primary_key.columns))
+            while True:
+                rows = result.fetchmany(chunk_size)
+                if not rows:
+                    break
+                output.write(''.join(json.dumps({'table': table.name, 'row': dict(
+                    (key, _encode(value)) for key, value in row.items())}) + '\n' for row in rows))
+                count += len(rows)
+            report.add(table.name, count, time.time() - start)
+    report.end = time.time()
+    return report
+
+
+def load(lines, chunk_size=CHUNK_SIZE, transaction_size=TRANSACTION_SIZE):
+    """Insert the rows read from the NDJSON ``lines`` (any iterable, such
+    as an open file) into the database of the application, return a
+    :class:`Report`.
+
+    The id sequences are moved past the imported ids, the counters of the
+    users recomputed, and the timelines and search index rebuilt when they
+    are not kept up to date by the database itself.
+    """
+    report = Report()
+    tables = dict((table.name, table) for table in TABLES)
+    decoders = dict((table.name, _decoder(table)) for table in TABLES)
+
+    def insert(name, chunk, start):
+        connection.execute(tables[name].insert(), chunk)
+        report.add(name, len(chunk), time.time() - start)
+
+    connection = db.engine.connect()
+    try:
+        transaction = connection.begin()
+        name, chunk, pending = None, [], 0
+        start = time.time()
+        for line in lines:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['table'] not in tables:
+                raise ValueError('Unknown table %r' % record['table'])
+            if chunk and (record['table'] != name or len(chunk) >= chunk_size):
+                insert(name, chunk, start)
+                pending += len(chunk)
+                chunk = []
+                if pending >= transaction_size:
+                    transaction.commit()
+                    transaction = connection.begin()
+                    pending = 0
+                start = time.time()
+            name = record['table']
+            chunk.append(decoders[name](record['row']))
+        if chunk:
+            insert(name, chunk, start)
+        _reset_sequences(connection, [tables[name] for name in report.rows])
+        transaction.commit()
+    finally:
+        connection.close()
+
+    if report.rows:
+        User.reconcile_counters()
+        if current_app.config.get('TIMELINE_ENABLED'):
+            User.rebuild_timelines()
+        search = get_backend()
+        if 'users_post' in report.rows and not search.transactional:
+            search.reindex()
+    report.end = time.time()
+    return report
+
+
+def _reset_sequences(connection, tables):
+    """Make the next ids of ``tables`` follow the largest one inserted.
+
+    SQLite and MySQL move their counters past explicit ids by themselves,
+    PostgreSQL sequences have to be set.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        if 'id' in table.c:
+            connection.execute(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), coalesce(max(id), 1), "
+                "max(id) IS NOT NULL) FROM %s" % (table.name, table.name))
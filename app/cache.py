@@ -0,0 +1,52 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache(object):
+    """A thread safe in-process cache holding at most ``maxsize`` entries,
+    optionally expiring them ``ttl`` seconds after they were set.
+
+    It follows the ``get``/``set``/``delete``/``clear`` interface of the
+    werkzeug caches, so one of those can be used wherever it is expected.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return None
+            if expires is not None and expires < time.time():
+                return None
+            # re-insert to mark the entry as the most recently used one
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, timeout=None):
+        ttl = self.ttl if timeout is None else timeout
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def __len__(self):
+        return len(self._data)
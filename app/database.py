@@ -0,0 +1,186 @@
+import os
+import random
+import time
+from threading import Lock
+
+import flask
+from flask.ext import sqlalchemy as flask_sqlalchemy
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool, NullPool, QueuePool, StaticPool
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+# flask session key of the time until which the user reads from the primary
+STICKY_KEY = '_primary_until'
+
+
+def is_write(clause):
+    """Whether executing ``clause`` could change the database."""
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith('SELECT')
+    return False
+
+
+@event.listens_for(Pool, 'connect')
+def _record_pid(connection, record):
+    record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(connection, record, proxy):
+    # a connection inherited from the parent of a forked process: let the
+    # pool replace it, without closing it under the parent's feet
+    if record.info.get('pid', os.getpid()) != os.getpid():
+        record.connection = proxy.connection = None
+        raise exc.DisconnectionError('Connection opened by process %s, used by %s'
+                                     % (record.info['pid'], os.getpid()))
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """A session reading from a replica of SQLALCHEMY_REPLICAS, when there
+    are any, and writing to the primary database.
+
+    The first write (a flush, or an INSERT, UPDATE or DELETE statement)
+    pins the session to the primary for the rest of its life, so that it
+    reads its own writes; committing it also sends the reads of the current
+    user's next requests to the primary for REPLICA_STICKY_SECONDS, while
+    the replicas catch up.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        self._replica = None
+        self.pinned = False
+        flask_sqlalchemy.SignallingSession.__init__(self, db, **options)
+        event.listen(self, 'after_commit', self._after_commit)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self.pinned and (self._flushing or is_write(clause)):
+            self.pinned = True
+        # a bare connection() could be used for anything, and the tables of
+        # other binds have no replicas
+        if self.pinned or clause is None or self._sticky() or (
+                mapper is not None and mapper.mapped_table.info.get('bind_key')):
+            return flask_sqlalchemy.SignallingSession.get_bind(self, mapper, clause)
+        if self._replica is None:
+            replicas = self._db.get_replica_engines(self.app)
+            if not replicas:
+                return flask_sqlalchemy.SignallingSession.get_bind(self, mapper, clause)
+            # one replica per session, so that it reads a consistent state
+            self._replica = random.choice(replicas)
+        return self._replica
+
+    def close(self):
+        flask_sqlalchemy.SignallingSession.close(self)
+        self._replica = None
+        self.pinned = False
+
+    def _sticky(self):
+        return flask.has_request_context() and flask.session.get(STICKY_KEY, 0) > time.time()
+
+    def _after_commit(self, session):
+        if self.pinned and flask.has_request_context() and self.app.config['SQLALCHEMY_REPLICAS']:
+            flask.session[STICKY_KEY] = time.time() + self.app.config['REPLICA_STICKY_SECONDS']
+
+
+class _EngineConnector(flask_sqlalchemy._EngineConnector):
+    """Runs the SQLITE_PRAGMAS of its application on every new connection
+    of the SQLite engines it creates, and only on those."""
+
+    def __init__(self, sa, app, bind=None):
+        flask_sqlalchemy._EngineConnector.__init__(self, sa, app, bind)
+        self._prepared = None
+        self._prepared_lock = Lock()
+
+    def get_engine(self):
+        engine = flask_sqlalchemy._EngineConnector.get_engine(self)
+        # a new engine is created whenever the uri changes
+        if engine is not self._prepared:
+            with self._prepared_lock:
+                if engine is not self._prepared:
+                    if engine.dialect.name == 'sqlite':
+                        event.listen(engine, 'connect', self._apply_pragmas)
+                    self._prepared = engine
+        return engine
+
+    def _apply_pragmas(self, connection, record):
+        cursor = connection.cursor()
+        for name, value in self._app.config['SQLITE_PRAGMAS']:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+class _ReplicaConnector(_EngineConnector):
+    def __init__(self, sa, app, uri):
+        _EngineConnector.__init__(self, sa, app)
+        self._uri = uri
+
+    def get_uri(self):
+        return self._uri
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """Flask-SQLAlchemy, configured for production use.
+
+    DATABASE_CONNECT_OPTIONS are passed to the DB-API ``connect()``, file
+    based SQLite databases are pooled like the others (SQLALCHEMY_POOL_*)
+    and every new connection of its SQLite engines runs the SQLITE_PRAGMAS
+    of their application. Sessions read
+    from the SQLALCHEMY_REPLICAS, see :class:`RoutingSession`. Connections
+    are never shared between processes: a forked process opens its own.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._replicas = {}
+        self._replicas_lock = Lock()
+        flask_sqlalchemy.SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('DATABASE_CONNECT_OPTIONS', {})
+        app.config.setdefault('SQLITE_PRAGMAS', [])
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('REPLICA_STICKY_SECONDS', 10)
+        flask_sqlalchemy.SQLAlchemy.init_app(self, app)
+
+    def make_connector(self, app, bind=None):
+        return _EngineConnector(self, app, bind)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def get_replica_engines(self, app):
+        """The engines of the configured replicas."""
+        uris = app.config['SQLALCHEMY_REPLICAS']
+        with self._replicas_lock:
+            for uri in uris:
+                if (app, uri) not in self._replicas:
+                    self._replicas[app, uri] = _ReplicaConnector(self, app, uri)
+        return [self._replicas[app, uri].get_engine() for uri in uris]
+
+    def dispose(self, app):
+        """Drop the pooled connections of the engines of ``app``, such as
+        the ones a forked worker inherits from its parent."""
+        state = flask_sqlalchemy.get_state(app)
+        engines = [connector._engine for connector in state.connectors.values()]
+        engines.extend(connector._engine for (owner, uri), connector in self._replicas.items()
+                       if owner is app)
+        for engine in engines:
+            if engine is not None:
+                engine.dispose()
+
+    def apply_driver_hacks(self, app, info, options):
+        connect_args = dict(app.config['DATABASE_CONNECT_OPTIONS'])
+        if info.drivername == 'sqlite' and options.get('pool_size'):
+            # pooled connections are handed from thread to thread, but
+            # never used by two threads at once
+            connect_args.setdefault('check_same_thread', False)
+        options.setdefault('connect_args', {}).update(connect_args)
+        flask_sqlalchemy.SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername == 'sqlite' and options.get('pool_size'):
+            # SQLAlchemy would open a connection per checkout otherwise
+            options.setdefault('poolclass', QueuePool)
+        if options.get('poolclass') in (NullPool, StaticPool):
+            # in memory SQLite databases, or an explicit pool size of 0
+            for name in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(name, None)
@@ -1,26 +1,85 @@
-from flask import render_template
+from datetime import datetime
+from itertools import groupby
+
+from flask import render_template, current_app
 from flask.ext.mail import Message
-from flask import current_app
-from flask.ext.babel import gettext
+from flask.ext.babel import gettext, ngettext
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
-from app import app, mail
-from decorators import async
+from app import db, mail_queue
+from app.users.models import FollowEvent, followers
 from config import ADMINS
 
-@async
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-
-def send_email(subject, sender, recipients, text_body, html_body):
+def send_email(subject, sender, recipients, text_body, html_body, when_committed=False):
+    """Queue a mail, or with ``when_committed`` hold it until the current
+    transaction commits, dropping it if it is rolled back instead."""
     msg = Message(subject=subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    send_async_email(current_app, msg)
+    if when_committed:
+        db.session().info.setdefault('outbox', []).append(msg)
+    else:
+        mail_queue.put(msg)
+
+@event.listens_for(Session, 'after_commit')
+def _queue_committed(session):
+    # also called when a SAVEPOINT is released, which commits nothing yet
+    if session.transaction._parent is None:
+        for msg in session.info.pop('outbox', ()):
+            mail_queue.put(msg)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_rolled_back(session, previous_transaction):
+    # the mails of a transaction outlive the rollback of its savepoints
+    if previous_transaction._parent is None:
+        session.info.pop('outbox', None)
 
 def follower_notification(followed, follower):
+    if current_app.config['FOLLOWER_NOTIFICATIONS'] == 'digest':
+        # announced later by send_follower_digests(), within the follow transaction
+        db.session.add(FollowEvent(followed=followed, follower=follower,
+                                   timestamp=datetime.utcnow()))
+        return
     send_email(gettext('[microblog] %(follower_name)s is now following you!', follower_name=follower.name),
                ADMINS[0],
-               [follower.email],
+               [followed.email],
                render_template('users/follower_email.txt', user=followed, follower=follower),
-               render_template('users/follower_email.html', user=followed, follower=follower))
+               render_template('users/follower_email.html', user=followed, follower=follower),
+               when_committed=True)
+
+def send_follower_digests():
+    """Send every user one mail announcing all the followers recorded
+    since the last run, return the number of mails sent."""
+    last_id = db.session.query(db.func.max(FollowEvent.id)).scalar()
+    if last_id is None:
+        return 0
+    # skip the follows that were undone in the meantime
+    events = FollowEvent.query.join(followers, db.and_(
+        followers.c.followed_id == FollowEvent.followed_id,
+        followers.c.follower_id == FollowEvent.follower_id)).filter(
+        FollowEvent.id <= last_id).options(
+        db.joinedload('followed'), db.joinedload('follower')).order_by(
+        FollowEvent.followed_id, FollowEvent.id)
+    sent = 0
+    limit = current_app.config['FOLLOWER_DIGEST_MAX_LISTED']
+    for followed_id, group in groupby(events, lambda event: event.followed_id):
+        group = list(group)
+        followed = group[0].followed
+        # followed, unfollowed and followed again: announced once
+        new_followers = []
+        for event in group:
+            if event.follower not in new_followers:
+                new_followers.append(event.follower)
+        send_email(ngettext('[microblog] %(num)d new follower', '[microblog] %(num)d new followers',
+                            len(new_followers)),
+                   ADMINS[0],
+                   [followed.email],
+                   render_template('users/follower_digest.txt', user=followed,
+                                   followers=new_followers[:limit], count=len(new_followers)),
+                   render_template('users/follower_digest.html', user=followed,
+                                   followers=new_followers[:limit], count=len(new_followers)))
+        sent += 1
+    FollowEvent.query.filter(FollowEvent.id <= last_id).delete(synchronize_session=False)
+    db.session.commit()
+    return sent
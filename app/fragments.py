@@ -0,0 +1,68 @@
+from hashlib import md5
+
+from flask import current_app, render_template
+from flask.ext.babel import get_locale
+from jinja2 import Markup
+from werkzeug.utils import import_string
+
+from .cache import LRUCache
+from .momentjs import time_bucket
+
+
+class FragmentCache(object):
+    """Caches rendered template fragments.
+
+    Entries live in an in-process :class:`~app.cache.LRUCache` of
+    FRAGMENT_CACHE_SIZE entries, unless FRAGMENT_CACHE_BACKEND names a
+    werkzeug cache class (such as ``werkzeug.contrib.cache.MemcachedCache``)
+    to build with FRAGMENT_CACHE_OPTIONS and share between processes.
+    Every application has its own backend.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config['FRAGMENT_CACHE_BACKEND']
+        if backend is None:
+            backend = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'])
+        else:
+            backend = import_string(backend)(**app.config['FRAGMENT_CACHE_OPTIONS'])
+        app.extensions['fragment_cache'] = backend
+
+    @property
+    def backend(self):
+        """The backend of the current application."""
+        return current_app.extensions['fragment_cache']
+
+    def render(self, key, template, **context):
+        backend = self.backend
+        html = backend.get(key)
+        if html is None:
+            html = render_template(template, **context)
+            backend.set(key, html)
+        return Markup(html)
+
+    def post_key(self, id, timestamp, author_name, author_email):
+        """Changes whenever the rendering of the post ``id`` does. Takes the
+        rows of :meth:`~app.users.models.Post.versions` as arguments."""
+        key = 'post:%d:%s:%s' % (id, get_locale(), author_version(author_name, author_email))
+        if current_app.config['MOMENTJS_MODE'] == 'server':
+            # the fragment shows the age of the post
+            key += ':%d' % time_bucket(timestamp)
+        return key
+
+    def render_post(self, post):
+        """Render ``users/post.html`` for ``post``, from the cache when possible."""
+        key = self.post_key(post.id, post.timestamp, post.author.name, post.author.email)
+        return self.render(key, 'users/post.html', post=post)
+
+    def clear(self):
+        self.backend.clear()
+
+
+def author_version(name, email):
+    """Changes whenever the author data shown next to a post does, so that
+    editing a profile invalidates the fragments of its posts."""
+    return md5((u'%s|%s' % (name, email)).encode('utf-8')).hexdigest()[:12]
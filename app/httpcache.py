@@ -0,0 +1,68 @@
+"""Conditional GET of the pages rendered for the signed in user.
+
+A view computes the ETag of its page out of cheap lookups of what the page
+shows, such as the :meth:`~app.users.models.Post.versions` of its posts,
+and lets :func:`conditional` answer ``304 Not Modified`` when the client
+already holds that page, before loading or rendering anything else::
+
+    versions = Post.versions(ids)
+    tag = page_etag(query, [fragment_cache.post_key(*version) for version in versions])
+    return conditional(tag, lambda: render_template(
+        'search_results.html', results=Post.load(ids), ...))
+
+The pages differ per user and language, so they are only cached by the
+browser (``private``), which asks again every time (``no-cache``).
+"""
+
+import os
+import time
+from hashlib import md5
+
+from flask import current_app, g, request, session, make_response
+
+
+def init_http_cache(app):
+    """Digest the templates and translations of ``app`` into the ETags, so
+    that deploying new ones changes every page."""
+    digest = md5()
+    for directory in (app.template_folder, 'translations'):
+        for root, dirs, files in sorted(os.walk(os.path.join(app.root_path, directory))):
+            for name in sorted(files):
+                if not name.startswith('.') and not name.endswith('.po'):
+                    with open(os.path.join(root, name), 'rb') as f:
+                        digest.update(f.read())
+    app.extensions['http_cache'] = digest.hexdigest()
+
+
+def page_etag(*parts):
+    """The ETag of a page rendered from ``parts``, for the current viewer
+    and language, or None if the page must be rendered anyway."""
+    if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+        # the messages are only shown once
+        return None
+    config = current_app.config
+    # pages carry CSRF tokens valid for WTF_CSRF_TIME_LIMIT seconds: one
+    # validated again within half of it is still usable
+    csrf = None
+    if config['WTF_CSRF_ENABLED']:
+        time_limit = config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        bucket = int(time.time() // (time_limit / 2.0)) if time_limit else None
+        csrf = (session.get('csrf_token'), bucket)
+    viewer = (g.user.id, g.user.name) if g.user else None
+    validator = repr((current_app.extensions['http_cache'], str(g.locale),
+                      config['MOMENTJS_MODE'], viewer, csrf, parts))
+    return md5(validator.encode('utf-8')).hexdigest()
+
+
+def conditional(etag, render):
+    """Answer 304 if the client holds the page tagged ``etag``, else the
+    response returned by ``render()``."""
+    if etag is not None and etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.update(('Accept-Language', 'Cookie'))
+    return response
@@ -0,0 +1,109 @@
+import os
+from threading import Lock
+
+from babel import Locale, support
+from flask import current_app, request, _request_ctx_stack
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
+
+from .cache import LRUCache
+
+
+class I18nCache(object):
+    """Process wide caches of the per request i18n work, for each application.
+
+    Flask-Babel parses the Accept-Language header, then loads and merges
+    the catalogs of the locale from disk, on every request. Here the locale
+    chosen for each header value is memoized, and the catalogs of every
+    locale are loaded once (by :meth:`warm` at startup) and handed to each
+    request before Flask-Babel, or Flask-WTF for the WTForms messages, look
+    for them.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['i18n'] = _I18nState(app.config['ACCEPT_LANGUAGE_CACHE_SIZE'])
+        app.before_request(self._before_request)
+
+    def best_match(self, header):
+        """The LANGUAGES key best matching an Accept-Language ``header``,
+        or None."""
+        choices = current_app.extensions['i18n'].choices
+        choice = choices.get(header)
+        if choice is None:
+            accept = parse_accept_header(header, LanguageAccept)
+            choice = (accept.best_match(current_app.config['LANGUAGES'].keys()),)
+            choices.set(header, choice)
+        return choice[0]
+
+    def locale(self, name):
+        """The :class:`babel.Locale` named ``name``, the default one for None."""
+        if name is None:
+            name = current_app.config['BABEL_DEFAULT_LOCALE']
+        locales = current_app.extensions['i18n'].locales
+        locale = locales.get(name)
+        if locale is None:
+            locale = locales.setdefault(name, Locale.parse(name))
+        return locale
+
+    def translations(self, locale, domain='messages'):
+        """The merged catalogs of ``locale``, like Flask-Babel's
+        ``get_translations()`` builds them, or the WTForms catalog when
+        ``domain`` is 'wtforms'."""
+        state = current_app.extensions['i18n']
+        key = (str(locale), domain)
+        translations = state.translations.get(key)
+        if translations is None:
+            with state.lock:
+                translations = state.translations.get(key)
+                if translations is None:
+                    translations = self._load(locale, domain)
+                    state.translations[key] = translations
+        return translations
+
+    def _load(self, locale, domain):
+        if domain == 'wtforms':
+            try:
+                from wtforms.i18n import messages_path
+            except ImportError:
+                from wtforms.ext.i18n.utils import messages_path
+            return support.Translations.load(messages_path(), [locale], domain=domain)
+        translations = support.Translations()
+        for dirname in translation_directories(current_app):
+            catalog = support.Translations.load(dirname, [locale], domain=domain)
+            translations.merge(catalog)
+            if hasattr(catalog, 'plural'):
+                translations.plural = catalog.plural
+        return translations
+
+    def warm(self):
+        """Load the catalogs of every language."""
+        for name in [None] + list(current_app.config['LANGUAGES']):
+            self.translations(self.locale(name))
+            self.translations(self.locale(name), 'wtforms')
+
+    def _before_request(self):
+        locale = self.locale(self.best_match(request.headers.get('Accept-Language', '')))
+        # where Flask-Babel's get_locale() and get_translations() look first
+        request.babel_locale = locale
+        request.babel_translations = self.translations(locale)
+        _request_ctx_stack.top.wtforms_translations = self.translations(locale, 'wtforms')
+
+
+class _I18nState(object):
+    """The caches of one application."""
+
+    def __init__(self, size):
+        self.choices = LRUCache(maxsize=size)
+        self.locales = {}
+        self.translations = {}
+        self.lock = Lock()
+
+
+def translation_directories(app):
+    """Where Flask-Babel looks for the catalogs of ``app``."""
+    for path in app.config.get('BABEL_TRANSLATION_DIRECTORIES', 'translations').split(';'):
+        yield path if os.path.isabs(path) else os.path.join(app.root_path, path)
@@ -0,0 +1,176 @@
+import atexit
+import os
+import smtplib
+import socket
+import time
+from threading import Lock, Thread
+from weakref import WeakSet
+
+try:
+    from Queue import Queue, Full, Empty  # python 2
+except ImportError:
+    from queue import Queue, Full, Empty  # python 3
+
+from flask import current_app
+
+_STOP = object()
+
+# the queues of every application, drained when the interpreter exits
+_queues = WeakSet()
+
+
+class MailQueue(object):
+    """A bounded queue of outgoing messages drained by a fixed pool of
+    MAIL_WORKERS threads.
+
+    Each worker sends up to MAIL_BATCH_SIZE queued messages over a single
+    SMTP connection and retries a failed batch MAIL_RETRIES times with an
+    exponential backoff. When the queue is full :meth:`put` waits up to
+    MAIL_QUEUE_TIMEOUT seconds for room before dropping the message.
+
+    Every application has its own queue, used through the current one. The
+    workers are started by the first :meth:`put` of each process, so a
+    queue created before a server forks works in every worker.
+    """
+
+    def __init__(self, app=None, mail=None):
+        if app is not None:
+            self.init_app(app, mail)
+
+    def init_app(self, app, mail):
+        queue = _AppMailQueue(app, mail)
+        app.extensions['mail_queue'] = queue
+        _queues.add(queue)
+
+    def get_queue(self, app=None):
+        """The queue of ``app``, of the current application by default."""
+        return (app or current_app).extensions['mail_queue']
+
+    def put(self, message):
+        """Queue ``message`` for sending, return False if it was dropped."""
+        return self.get_queue().put(message)
+
+    def qsize(self):
+        return self.get_queue().qsize()
+
+    def join(self):
+        """Block until every queued message was sent or given up on."""
+        self.get_queue().join()
+
+    def shutdown(self, timeout=None):
+        """Let the workers send what is queued, then stop them."""
+        self.get_queue().shutdown(timeout)
+
+
+@atexit.register
+def _shutdown_queues():
+    for queue in list(_queues):
+        queue.shutdown(queue.app.config['MAIL_SHUTDOWN_TIMEOUT'])
+
+
+class _AppMailQueue(object):
+    """The queue and the workers of one application."""
+
+    def __init__(self, app, mail):
+        self.app = app
+        self.mail = mail
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._reset()
+
+    def _reset(self):
+        # the process owning the queue and its workers: a forked child
+        # starts its own, without the messages of its parent
+        self._pid = os.getpid()
+        self._queue = Queue(self.app.config['MAIL_QUEUE_SIZE'])
+        self._workers = []
+        self._lock = Lock()
+
+    def put(self, message):
+        if self._pid != os.getpid():
+            self._reset()
+        self._start()
+        try:
+            self._queue.put(message, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except Full:
+            with self._lock:
+                self.dropped += 1
+            self.app.logger.error('Mail queue full, dropping message %r', message.subject)
+            return False
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def join(self):
+        self._queue.join()
+
+    def shutdown(self, timeout=None):
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            self._queue.put(_STOP)
+        deadline = time.time() + (timeout or 0)
+        for worker in workers:
+            worker.join(max(deadline - time.time(), 0) if timeout else None)
+
+    def _start(self):
+        count = self.app.config['MAIL_WORKERS']
+        if len(self._workers) == count and all(worker.is_alive() for worker in self._workers):
+            return
+        with self._lock:
+            # replace the workers killed by an unexpected error
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < count:
+                worker = Thread(target=self._work, args=(self._queue,))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self, queue):
+        stop = False
+        while not stop:
+            batch = [queue.get()]
+            while len(batch) < self.app.config['MAIL_BATCH_SIZE'] and batch[-1] is not _STOP:
+                try:
+                    batch.append(queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is _STOP:
+                stop = True
+            messages = [message for message in batch if message is not _STOP]
+            try:
+                if messages:
+                    self._send(messages)
+            except Exception:
+                # not worth retrying (a bad header, ...), but the worker goes on
+                with self._lock:
+                    self.failed += len(messages)
+                self.app.logger.exception('Cannot send %d messages', len(messages))
+            finally:
+                for item in batch:
+                    queue.task_done()
+
+    def _send(self, messages):
+        retries = self.app.config['MAIL_RETRIES']
+        with self.app.app_context():
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(self.app.config['MAIL_RETRY_BACKOFF'] * 2 ** (attempt - 1))
+                try:
+                    with self.mail.connect() as connection:
+                        while messages:
+                            connection.send(messages[0])
+                            messages.pop(0)
+                            with self._lock:
+                                self.sent += 1
+                    return
+                except (smtplib.SMTPException, socket.error):
+                    self.app.logger.warning('Cannot send mail (attempt %d of %d)',
+                                            attempt + 1, retries + 1, exc_info=True)
+            with self._lock:
+                self.failed += len(messages)
+            self.app.logger.error('Giving up on %d messages', len(messages))
@@ -0,0 +1,85 @@
+"""Schema migrations.
+
+``db.create_all()`` only creates missing tables, so databases created
+before a column, index or constraint was added to the models are brought
+up to date here. Every migration checks the live schema before changing
+anything, so :func:`upgrade` can be run any number of times.
+"""
+
+from sqlalchemy import inspect, select, table, column
+
+from app import db
+from app.search import get_backend
+from app.users.models import followers, insert_or_ignore
+
+
+def followers_primary_key(connection):
+    """Rebuild ``followers`` with its composite primary key, dropping the
+    duplicate rows the old table allowed."""
+    if inspect(connection).get_pk_constraint('followers')['constrained_columns']:
+        return False
+    connection.execute('ALTER TABLE followers RENAME TO followers_old')
+    followers.create(connection)
+    old = table('followers_old', column('follower_id'), column('followed_id'))
+    connection.execute(insert_or_ignore(followers).from_select(
+        ['follower_id', 'followed_id'],
+        select([old.c.follower_id, old.c.followed_id]).where(
+            old.c.follower_id != None).where(old.c.followed_id != None)))
+    connection.execute('DROP TABLE followers_old')
+    return True
+
+
+def user_counters(connection):
+    """Add the denormalized counter columns of ``users_user`` and fill them."""
+    columns = set(info['name'] for info in inspect(connection).get_columns('users_user'))
+    added = False
+    for name in ('followers_count', 'following_count', 'posts_count'):
+        if name not in columns:
+            connection.execute('ALTER TABLE users_user ADD COLUMN %s INTEGER DEFAULT 0' % name)
+            added = True
+    if added:
+        connection.execute(
+            'UPDATE users_user SET '
+            'followers_count = (SELECT count(*) FROM followers WHERE followed_id = users_user.id), '
+            'following_count = (SELECT count(*) FROM followers WHERE follower_id = users_user.id), '
+            'posts_count = (SELECT count(*) FROM users_post WHERE user_id = users_user.id)')
+    return added
+
+
+def missing_indexes(connection):
+    """Create the indexes declared on the models but absent from the database."""
+    created = False
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                created = True
+    return created
+
+
+def search_index(connection):
+    """Create and fill the index of the configured search backend."""
+    return get_backend().install(connection)
+
+
+MIGRATIONS = [
+    followers_primary_key,
+    user_counters,
+    missing_indexes,
+    search_index,
+]
+
+
+def upgrade(engine=None):
+    """Create the missing tables and apply every pending migration, return
+    the names of the migrations that changed something."""
+    engine = engine or db.engine
+    db.metadata.create_all(engine)
+    applied = []
+    with engine.begin() as connection:
+        for migration in MIGRATIONS:
+            if migration(connection):
+                applied.append(migration.__name__)
+    return applied
@@ -1,6 +1,50 @@
-from jinja2 import Markup
+from datetime import datetime, timedelta
+
+from babel.dates import format_timedelta
+from flask import current_app
+from flask.ext.babel import format_datetime, get_locale
+from jinja2 import Markup, escape
+
+from .cache import LRUCache
+
+# relative times already formatted, by locale and bucket
+_relative_times = LRUCache(maxsize=1024)
+
+
+def time_bucket(timestamp, now=None):
+    """The age of ``timestamp`` in seconds, rounded down to the minute
+    during the first hour, to the hour during the first day and to the day
+    after that. Timestamps of one bucket are shown the same way."""
+    age = max(int(((now or datetime.utcnow()) - timestamp).total_seconds()), 0)
+    if age < 3600:
+        return max(age // 60, 1) * 60
+    if age < 86400:
+        return age // 3600 * 3600
+    return age // 86400 * 86400
+
+
+def relative_time(timestamp, now=None):
+    """'5 minutes ago' in the language of the current request."""
+    locale = get_locale() or 'en'
+    bucket = time_bucket(timestamp, now)
+    key = (str(locale), bucket)
+    text = _relative_times.get(key)
+    if text is None:
+        text = format_timedelta(timedelta(seconds=-bucket), granularity='minute',
+                                add_direction=True, locale=locale)
+        _relative_times.set(key, text)
+    return text
+
 
 class momentjs(object):
+    """Renders a UTC timestamp with moment.js.
+
+    With MOMENTJS_MODE set to 'client' every call emits a script writing the
+    time. In 'server' mode the time is written by the server, with Babel,
+    in a ``<time>`` element that static/js/moment-refresh.js, deferred,
+    keeps up to date.
+    """
+
     def __init__(self, timestamp):
         self.timestamp = timestamp
 
@@ -8,11 +52,25 @@ class momentjs(object):
         return Markup("<script>\ndocument.write(moment(\"%s\").%s);\n</script>" %
             (self.timestamp.strftime("%Y-%m-%dT%H:%M:%S Z"), format))
 
+    def render_time(self, text, format, pattern=None):
+        attributes = ' data-pattern="%s"' % escape(pattern) if pattern is not None else ''
+        return Markup('<time datetime="%s" data-format="%s"%s>%s</time>' % (
+            self.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"), format, attributes, escape(text)))
+
+    def server_side(self):
+        return current_app.config['MOMENTJS_MODE'] == 'server'
+
     def format(self, fmt):
+        if self.server_side():
+            return self.render_time(format_datetime(self.timestamp), 'format', fmt)
         return self.render("format(\"%s\")" % fmt)
 
     def calendar(self):
+        if self.server_side():
+            return self.render_time(format_datetime(self.timestamp), 'calendar')
         return self.render("calendar()")
 
     def fromNow(self):
+        if self.server_side():
+            return self.render_time(relative_time(self.timestamp), 'fromNow')
         return self.render("fromNow()")
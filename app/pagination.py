@@ -0,0 +1,82 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+OLDER = 'o'
+NEWER = 'n'
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(direction, timestamp, id):
+    """Pack a position in a timeline into an opaque, url safe string."""
+    raw = '%s|%s|%d' % (direction, timestamp.strftime(_TIMESTAMP_FORMAT), id)
+    return urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Inverse of :func:`encode_cursor`. Raises ValueError on garbage."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, timestamp, id = urlsafe_b64decode(
+            padded.encode('ascii')).decode('ascii').split('|')
+        if direction not in (OLDER, NEWER):
+            raise ValueError(direction)
+        return direction, datetime.strptime(timestamp, _TIMESTAMP_FORMAT), int(id)
+    except (TypeError, UnicodeError, ValueError):
+        raise ValueError('invalid cursor %r' % cursor)
+
+
+class KeysetPagination(object):
+    """A page of a newest first timeline addressed by cursors instead of
+    page numbers, so that deep pages cost the same as the first one and do
+    not shift when new items arrive.
+
+    Exposes ``items``, ``has_next`` and ``has_prev`` like Flask-SQLAlchemy's
+    ``Pagination``, plus ``next_cursor`` (older items) and ``prev_cursor``
+    (newer items).
+    """
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+
+    @property
+    def next_cursor(self):
+        if self.has_next:
+            last = self.items[-1]
+            return encode_cursor(OLDER, last.timestamp, last.id)
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev:
+            first = self.items[0]
+            return encode_cursor(NEWER, first.timestamp, first.id)
+
+
+def paginate_keyset(query, timestamp_column, id_column, cursor, per_page):
+    """Return a :class:`KeysetPagination` of ``query`` ordered newest first
+    on ``(timestamp_column, id_column)``, starting after ``cursor``.
+
+    The items must expose the same key as ``timestamp`` and ``id``
+    attributes. Both columns should be covered by an index.
+    """
+    query = query.order_by(None)
+    if cursor is None:
+        items = query.order_by(timestamp_column.desc(), id_column.desc()).limit(
+            per_page + 1).all()
+        return KeysetPagination(items[:per_page], len(items) > per_page, False)
+
+    direction, timestamp, id = decode_cursor(cursor)
+    if direction == OLDER:
+        items = query.filter(or_(timestamp_column < timestamp,
+                                 and_(timestamp_column == timestamp, id_column < id))).order_by(
+            timestamp_column.desc(), id_column.desc()).limit(per_page + 1).all()
+        return KeysetPagination(items[:per_page], len(items) > per_page, True)
+
+    items = query.filter(or_(timestamp_column > timestamp,
+                             and_(timestamp_column == timestamp, id_column > id))).order_by(
+        timestamp_column.asc(), id_column.asc()).limit(per_page + 1).all()
+    newest_first = list(reversed(items[:per_page]))
+    return KeysetPagination(newest_first, True, len(items) > per_page)
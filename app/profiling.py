@@ -0,0 +1,142 @@
+import time
+from threading import Lock, local
+from weakref import WeakSet
+
+from flask import current_app, request
+from sqlalchemy import event
+
+
+class RequestProfiler(object):
+    """Records what every endpoint costs: wall time, number and duration of
+    SQL statements, and template rendering time.
+
+    The totals of each endpoint are returned by :meth:`stats`. Requests
+    slower than SLOW_REQUEST_TIME seconds and statements slower than
+    SLOW_QUERY_TIME seconds are logged as warnings, when these are set.
+
+    Only the statements of the engines of ``db`` for the application are
+    measured, and only while it handles a request.
+    """
+
+    def __init__(self, app=None, db=None):
+        # guards the registration of the listeners
+        self._lock = Lock()
+        # the measures of the request handled by the current thread
+        self._local = local()
+        self._engines = WeakSet()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.extensions['profiler'] = _ProfilerState(db)
+        app.before_request(self._start)
+        app.teardown_request(self._finish)
+        app.jinja_env.template_class = self._template_class(app.jinja_env.template_class)
+
+    def stats(self):
+        """Per endpoint totals of the current application, as a dict that
+        can be dumped to JSON."""
+        state = current_app.extensions['profiler']
+        with state.lock:
+            stats = {}
+            for endpoint, totals in state.stats.items():
+                stats[endpoint] = dict(totals)
+                stats[endpoint]['avg_time'] = totals['time'] / totals['requests']
+                stats[endpoint]['avg_queries'] = float(totals['queries']) / totals['requests']
+            return stats
+
+    def reset(self):
+        state = current_app.extensions['profiler']
+        with state.lock:
+            state.stats.clear()
+
+    def _start(self):
+        db = current_app.extensions['profiler'].db
+        # engines are created on first use, and again when their uri changes
+        for engine in [db.get_engine(current_app)] + db.get_replica_engines(current_app):
+            if engine not in self._engines:
+                with self._lock:
+                    if engine not in self._engines:
+                        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+                        event.listen(engine, 'handle_error', self._handle_error)
+                        self._engines.add(engine)
+        self._local.current = {'start': time.time(), 'queries': 0, 'sql_time': 0.0,
+                               'template_time': 0.0, 'rendering': 0}
+
+    def _finish(self, exception=None):
+        current = getattr(self._local, 'current', None)
+        if current is None:
+            return
+        self._local.current = None
+        elapsed = time.time() - current['start']
+        endpoint = request.endpoint or 'unknown'
+        state = current_app.extensions['profiler']
+        with state.lock:
+            totals = state.stats.setdefault(endpoint, {
+                'requests': 0, 'time': 0.0, 'max_time': 0.0, 'queries': 0,
+                'max_queries': 0, 'sql_time': 0.0, 'template_time': 0.0})
+            totals['requests'] += 1
+            totals['time'] += elapsed
+            totals['max_time'] = max(totals['max_time'], elapsed)
+            totals['queries'] += current['queries']
+            totals['max_queries'] = max(totals['max_queries'], current['queries'])
+            totals['sql_time'] += current['sql_time']
+            totals['template_time'] += current['template_time']
+        threshold = current_app.config['SLOW_REQUEST_TIME']
+        if threshold is not None and elapsed >= threshold:
+            current_app.logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries in %.3fs, templates %.3fs',
+                request.method, request.path, endpoint, elapsed, current['queries'],
+                current['sql_time'], current['template_time'])
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, 'current', None) is not None:
+            conn.info.setdefault('profiler_start', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        current = getattr(self._local, 'current', None)
+        starts = conn.info.get('profiler_start')
+        # or started before the listeners were registered
+        if current is None or not starts:
+            return
+        elapsed = time.time() - starts.pop()
+        current['queries'] += 1
+        current['sql_time'] += elapsed
+        threshold = current_app.config['SLOW_QUERY_TIME']
+        if threshold is not None and elapsed >= threshold:
+            current_app.logger.warning('Slow query (%.3fs): %s %r', elapsed, statement, parameters)
+
+    def _handle_error(self, context):
+        starts = context.connection.info.get('profiler_start') if context.connection else None
+        if starts:
+            starts.pop()
+
+    def _template_class(self, base):
+        profiler = self
+
+        class ProfiledTemplate(base):
+            def render(self, *args, **kwargs):
+                current = getattr(profiler._local, 'current', None)
+                if current is None:
+                    return base.render(self, *args, **kwargs)
+                # templates rendered from templates are counted once
+                current['rendering'] += 1
+                start = time.time()
+                try:
+                    return base.render(self, *args, **kwargs)
+                finally:
+                    current['rendering'] -= 1
+                    if not current['rendering']:
+                        current['template_time'] += time.time() - start
+
+        return ProfiledTemplate
+
+
+class _ProfilerState(object):
+    """The totals of one application."""
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = Lock()
+        self.stats = {}
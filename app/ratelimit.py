@@ -0,0 +1,170 @@
+import math
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock, local
+
+from flask import current_app, request, session, render_template
+
+
+class RateLimiter(object):
+    """Token buckets limiting how often a client may use an endpoint.
+
+    RATELIMITS maps a limit name, given to :meth:`limit`, to ``(requests,
+    seconds)``: a bucket holds up to ``requests`` tokens, refilled at
+    ``requests / seconds`` tokens per second, and every request takes one.
+    Clients are told apart by their signed in user, else by their address.
+
+    The buckets live in the memory of each process unless RATELIMIT_STORAGE
+    is 'sqlite', which shares them between the processes of a server
+    through the RATELIMIT_SQLITE_PATH file. Every application has its own
+    buckets.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        limits = app.config['RATELIMITS'].values()
+        # a bucket left alone this long is full again, as good as absent
+        expiry = max([seconds for requests, seconds in limits] or [0])
+        if app.config['RATELIMIT_STORAGE'] == 'sqlite':
+            storage = SQLiteStorage(app.config['RATELIMIT_SQLITE_PATH'], expiry)
+        else:
+            storage = MemoryStorage(app.config['RATELIMIT_MEMORY_KEYS'])
+        app.extensions['ratelimit'] = storage
+
+    @property
+    def storage(self):
+        """The buckets of the current application."""
+        return current_app.extensions['ratelimit']
+
+    def hit(self, name, client):
+        """Take a token from the ``name`` bucket of ``client``. Return 0 if
+        there was one, else the seconds until there is."""
+        limit = current_app.config['RATELIMITS'].get(name)
+        if limit is None or not current_app.config['RATELIMIT_ENABLED']:
+            return 0
+        requests, seconds = limit
+        try:
+            return self.storage.take('%s:%s' % (name, client), float(requests) / seconds,
+                                     requests, time.time())
+        except sqlite3.OperationalError:
+            # the shared buckets are locked by a slow worker, or worse: let
+            # the request through rather than fail it
+            current_app.logger.warning('Cannot check the %s rate limit of %s', name, client,
+                                       exc_info=True)
+            return 0
+
+    def limit(self, name, methods=None):
+        """Decorate a view to answer 429 Too Many Requests once the client
+        used up the ``name`` limit, counting only the requests of
+        ``methods`` (all of them by default)."""
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if methods is None or request.method in methods:
+                    wait = self.hit(name, client_key())
+                    if wait:
+                        return too_many_requests(wait)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+    def reset(self):
+        self.storage.clear()
+
+
+def client_key():
+    if 'user_id' in session:
+        return 'user:%s' % session['user_id']
+    return 'ip:%s' % request.remote_addr
+
+
+def too_many_requests(wait):
+    return render_template('429.html'), 429, {'Retry-After': str(int(math.ceil(wait)))}
+
+
+class MemoryStorage(object):
+    """The buckets of the last ``maxsize`` clients of this process."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, key, rate, capacity, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            if len(self._buckets) > self.maxsize:
+                # the least recently seen client, whose bucket is the fullest
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteStorage(object):
+    """Buckets in a SQLite file shared by the processes of a server.
+
+    Every thread has its own connection, and takes its token in an IMMEDIATE
+    transaction so that concurrent requests never spend the same one.
+    """
+
+    # rows of full buckets are deleted after this many takes per connection
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, expiry, timeout=5):
+        self.path = path
+        self.expiry = expiry
+        # seconds to wait for the lock held by another process
+        self.timeout = timeout
+        self._local = local()
+
+    def _connect(self):
+        state = self._local
+        # a forked child opens its own connections
+        if getattr(state, 'pid', None) != os.getpid():
+            state.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            # losing the last counts in a crash is fine, waiting on fsync is not
+            state.connection.execute('PRAGMA journal_mode=WAL')
+            state.connection.execute('PRAGMA synchronous=OFF')
+            state.connection.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                                     'key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            state.pid = os.getpid()
+            state.takes = 0
+        return state.connection
+
+    def take(self, key, rate, capacity, now):
+        connection = self._connect()
+        begun = False
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            begun = True
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE key = ?',
+                                     (key,)).fetchone()
+            tokens, updated = row or (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                               (key, tokens - 1 if not wait else tokens, now))
+            self._local.takes += 1
+            if self._local.takes % self.PURGE_EVERY == 0:
+                connection.execute('DELETE FROM buckets WHERE updated < ?', (now - self.expiry,))
+            connection.execute('COMMIT')
+        except Exception:
+            if begun:
+                connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def clear(self):
+        self._connect().execute('DELETE FROM buckets')
@@ -0,0 +1,496 @@
+"""Full text search of posts.
+
+The engine is picked by SEARCH_BACKEND: 'sqlite' indexes ``Post.body`` in
+an FTS5 table kept up to date by triggers, 'whoosh' keeps a Whoosh index
+in WHOOSH_BASE, fed in batches by a background :class:`IndexQueue`.
+
+The ranked ids found for a query are kept in a :class:`SearchCache` until
+posts that could change them are indexed.
+"""
+
+import atexit
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Condition, Lock, Thread, local
+
+from flask import current_app
+from flask.ext.sqlalchemy import models_committed
+from sqlalchemy import DDL, event, inspect
+
+from app import db
+from app.cache import LRUCache
+from app.users.models import Post
+
+try:
+    text_type = unicode  # python 2
+except NameError:
+    text_type = str  # python 3
+
+
+class SearchCache(object):
+    """Ranked post ids of recent queries, in an :class:`~app.cache.LRUCache`.
+
+    Entries are dropped when a post is indexed that has one of the index
+    terms of the query (stemmed and folded by the engine, so a superset of
+    the posts that could match it), or when one of the posts listed
+    changes. Queries whose terms are not known, such as wildcard searches,
+    are dropped whenever any post is indexed.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self._cache = LRUCache(maxsize, ttl)
+        self._lock = Lock()
+        # term -> keys and post id -> keys of the cached queries
+        self._by_term = {}
+        self._by_post = {}
+        self._unknown = set()
+        self._keys = set()
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, ids, terms=None):
+        """Cache the ``ids`` found for ``key``, a query with the index
+        ``terms`` (None when they are not known)."""
+        with self._lock:
+            # evicted entries linger in the indexes, start over once they
+            # take too much room
+            if len(self._keys) >= 2 * self.maxsize:
+                self._clear()
+            self._keys.add(key)
+            if terms is None:
+                self._unknown.add(key)
+            for term in terms or ():
+                self._by_term.setdefault(term, set()).add(key)
+            for id in ids:
+                self._by_post.setdefault(id, set()).add(key)
+            self._cache.set(key, ids)
+
+    def invalidate(self, changes):
+        """Drop the queries affected by ``changes``, a ``{post id: terms}``
+        dict of the index terms of the posts, None for deleted posts."""
+        with self._lock:
+            stale = set()
+            for id, terms in changes.items():
+                stale.update(self._by_post.pop(id, ()))
+                if terms is not None:
+                    for term in terms:
+                        stale.update(self._by_term.pop(term, ()))
+                    stale.update(self._unknown)
+                    self._unknown.clear()
+            for key in stale:
+                self._keys.discard(key)
+                self._cache.delete(key)
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._cache.clear()
+        self._by_term.clear()
+        self._by_post.clear()
+        self._unknown.clear()
+        self._keys.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SearchBackend(object):
+    """Interface of the search engines."""
+
+    # whether the database itself keeps the index up to date, even when
+    # posts are written without the ORM
+    transactional = False
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = SearchCache(app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'])
+
+    @classmethod
+    def listen_schema(cls):
+        """Hook the index into ``db.create_all()`` and ``db.drop_all()``."""
+
+    def close(self):
+        """Write what is pending."""
+
+    def _committed(self, app, changes):
+        changes = OrderedDict(
+            (model.id, None if operation == 'delete' else model.body)
+            for model, operation in changes if isinstance(model, Post))
+        if changes:
+            self.indexed(changes)
+
+    def indexed(self, changes):
+        """Called with ``{post id: body or None}`` once the changes are
+        searchable."""
+        self.cache.invalidate(dict((id, None if body is None else self.terms(body))
+                                   for id, body in changes.items()))
+
+    def terms(self, text):
+        """The set of index terms of ``text``, tokenized like the posts."""
+        raise NotImplementedError
+
+    def query_terms(self, query):
+        """The index terms of ``query``, one of which a post must have to
+        match it, or None when they are not known."""
+        return self.terms(query)
+
+    def normalize(self, query):
+        """The cache key of ``query``: queries finding the same posts
+        should share it."""
+        return ' '.join(query.split())
+
+    def search(self, query, limit):
+        """Return the ids of at most ``limit`` posts matching ``query``,
+        best match first."""
+        raise NotImplementedError
+
+    def install(self, connection):
+        """Create the index in an existing database, return whether
+        anything was done."""
+        return False
+
+    def reindex(self):
+        """Rebuild the whole index from the posts table, return the number
+        of posts indexed."""
+        raise NotImplementedError
+
+    def stats(self):
+        """Metrics about the indexing, as a dict."""
+        return {'cached_queries': len(self.cache)}
+
+    def search_ids(self, query, limit):
+        """Like :meth:`search`, from the cache when possible."""
+        key = (self.normalize(query), limit)
+        ids = self.cache.get(key)
+        if ids is None:
+            ids = self.search(query, limit)
+            self.cache.set(key, ids, self.query_terms(query))
+        return ids
+
+    def search_posts(self, query, limit):
+        """Like :meth:`search_ids`, but load the posts and their authors."""
+        return Post.load(self.search_ids(query, limit))
+
+
+class SQLiteBackend(SearchBackend):
+    """An FTS5 index of ``users_post.body``. Triggers on ``users_post`` update
+    it in the same transaction as the posts themselves."""
+
+    table = 'users_post_fts'
+    transactional = True
+    tokenize = 'porter unicode61'
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS users_post_fts USING fts5("
+        "body, content='users_post', content_rowid='id', tokenize='%s')" % tokenize,
+        "CREATE TRIGGER IF NOT EXISTS users_post_fts_insert AFTER INSERT ON users_post BEGIN "
+        "INSERT INTO users_post_fts(rowid, body) VALUES (new.id, new.body); END",
+        "CREATE TRIGGER IF NOT EXISTS users_post_fts_delete AFTER DELETE ON users_post BEGIN "
+        "INSERT INTO users_post_fts(users_post_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+        "CREATE TRIGGER IF NOT EXISTS users_post_fts_update AFTER UPDATE ON users_post BEGIN "
+        "INSERT INTO users_post_fts(users_post_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+        "INSERT INTO users_post_fts(rowid, body) VALUES (new.id, new.body); END",
+    ]
+
+    _listening = False
+
+    @classmethod
+    def listen_schema(cls):
+        if cls._listening:
+            return
+        cls._listening = True
+        for statement in cls.statements:
+            event.listen(Post.__table__, 'after_create',
+                         DDL(statement).execute_if(dialect='sqlite'))
+        event.listen(Post.__table__, 'before_drop',
+                     DDL('DROP TABLE IF EXISTS %s' % cls.table).execute_if(dialect='sqlite'))
+
+    def __init__(self, app):
+        SearchBackend.__init__(self, app)
+        self._local = local()
+        self._check_dialect(db.get_engine(app).dialect)
+
+    @staticmethod
+    def _check_dialect(dialect):
+        # like the create_all() hooks above, only ever on SQLite
+        if dialect.name != 'sqlite':
+            raise RuntimeError("SEARCH_BACKEND 'sqlite' needs an SQLite database, not %s: "
+                               "set SEARCH_BACKEND to 'whoosh'" % dialect.name)
+
+    def terms(self, text):
+        # tokenized by a scratch FTS5 table of the same tokenizer, in the
+        # memory of each thread, and read back from its vocabulary
+        state = self._local
+        if getattr(state, 'pid', None) != os.getpid():
+            state.connection = sqlite3.connect(':memory:', isolation_level=None)
+            state.connection.execute(
+                "CREATE VIRTUAL TABLE scratch USING fts5(body, tokenize='%s')" % self.tokenize)
+            state.connection.execute("CREATE VIRTUAL TABLE vocabulary USING fts5vocab(scratch, 'row')")
+            state.pid = os.getpid()
+        connection = state.connection
+        connection.execute('BEGIN')
+        try:
+            connection.execute('INSERT INTO scratch(body) VALUES (?)', (text_type(text),))
+            return set(term for (term,) in connection.execute('SELECT term FROM vocabulary'))
+        finally:
+            connection.execute('ROLLBACK')
+
+    def search(self, query, limit):
+        # quote every word, so that the user input is never parsed as FTS5
+        # syntax; words are implicitly AND-ed
+        words = re.findall(r'\w+', query, re.UNICODE)
+        if not words:
+            return []
+        match = ' '.join('"%s"' % word for word in words)
+        return [id for (id,) in db.session.execute(
+            'SELECT rowid FROM users_post_fts WHERE users_post_fts MATCH :match '
+            'ORDER BY rank LIMIT :limit', {'match': match, 'limit': limit})]
+
+    def normalize(self, query):
+        # search() only looks at the words, and FTS5 ignores their case
+        return ' '.join(re.findall(r'\w+', query.lower(), re.UNICODE))
+
+    def install(self, connection):
+        self._check_dialect(connection.dialect)
+        if self.table in inspect(connection).get_table_names():
+            return False
+        for statement in self.statements:
+            connection.execute(statement)
+        connection.execute("INSERT INTO users_post_fts(users_post_fts) VALUES ('rebuild')")
+        return True
+
+    def reindex(self):
+        db.session.execute("INSERT INTO users_post_fts(users_post_fts) VALUES ('rebuild')")
+        db.session.commit()
+        self.cache.clear()
+        return Post.query.count()
+
+
+class IndexQueue(object):
+    """Collects changed posts and hands them to ``write`` in batches, from
+    a background thread.
+
+    A batch is written once it holds SEARCH_INDEX_BATCH_SIZE posts, or when
+    its oldest post has waited SEARCH_INDEX_MAX_STALENESS seconds. Several
+    changes of one post before a write collapse into the last one.
+    """
+
+    def __init__(self, app, write):
+        self.app = app
+        self.write = write
+        self.indexed = 0
+        self.batches = 0
+        self.failures = 0
+        self._reset()
+
+    def _reset(self):
+        # a forked child starts its own worker, the posts queued by its
+        # parent are written by the parent
+        self._pid = os.getpid()
+        self._pending = OrderedDict()
+        self._oldest = None
+        self._condition = Condition()
+        self._worker = None
+
+    def put(self, id, body):
+        """Queue post ``id`` for (re)indexing, or for removal when ``body`` is None."""
+        if self._pid != os.getpid():
+            self._reset()
+        with self._condition:
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.pop(id, None)
+            self._pending[id] = body
+            if self._worker is None:
+                self._worker = Thread(target=self._run)
+                self._worker.daemon = True
+                self._worker.start()
+            self._condition.notify()
+
+    def flush(self):
+        """Write whatever is pending right away."""
+        if self._pid != os.getpid():
+            return
+        with self._condition:
+            batch, self._pending = self._pending, OrderedDict()
+        self._write(batch)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._pending),
+                'oldest_pending_seconds': time.time() - self._oldest if self._pending else 0,
+                'indexed': self.indexed,
+                'batches': self.batches,
+                'failures': self.failures,
+            }
+
+    def _run(self):
+        batch_size = self.app.config['SEARCH_INDEX_BATCH_SIZE']
+        staleness = self.app.config['SEARCH_INDEX_MAX_STALENESS']
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                while len(self._pending) < batch_size:
+                    left = self._oldest + staleness - time.time()
+                    if left <= 0:
+                        break
+                    self._condition.wait(left)
+                batch, self._pending = self._pending, OrderedDict()
+            self._write(batch)
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            self.write(batch)
+        except Exception:
+            self.app.logger.exception('Cannot index %d posts', len(batch))
+            with self._condition:
+                self.failures += 1
+                # retry later, unless the post changed again in the meantime
+                if not self._pending:
+                    self._oldest = time.time()
+                for id, body in batch.items():
+                    self._pending.setdefault(id, body)
+            return
+        with self._condition:
+            self.indexed += len(batch)
+            self.batches += 1
+
+
+class WhooshBackend(SearchBackend):
+    """A Whoosh index of ``Post.body`` in WHOOSH_BASE.
+
+    Committed posts are queued in an :class:`IndexQueue`, so requests do not
+    wait for the Whoosh writer lock; they become searchable within
+    SEARCH_INDEX_MAX_STALENESS seconds.
+    """
+
+    def __init__(self, app):
+        SearchBackend.__init__(self, app)
+        from whoosh import index
+        from whoosh.analysis import StemmingAnalyzer
+        from whoosh.fields import Schema, ID, TEXT
+        self.schema = Schema(id=ID(stored=True, unique=True),
+                             body=TEXT(analyzer=StemmingAnalyzer()))
+        self.path = os.path.join(app.config['WHOOSH_BASE'], 'Post')
+        if index.exists_in(self.path):
+            self.index = index.open_dir(self.path)
+        else:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self.index = index.create_in(self.path, self.schema)
+        self.queue = IndexQueue(app, self.write)
+        atexit.register(self.queue.flush)
+
+    def close(self):
+        self.queue.flush()
+
+    def _committed(self, app, changes):
+        for model, operation in changes:
+            if isinstance(model, Post):
+                self.queue.put(model.id, None if operation == 'delete' else model.body)
+
+    def write(self, batch):
+        """Apply a batch of ``{post id: body or None}`` to the index."""
+        writer = self.index.writer(timeout=self.app.config['SEARCH_INDEX_MAX_STALENESS'])
+        for id, body in batch.items():
+            if body is None:
+                writer.delete_by_term('id', text_type(id))
+            else:
+                writer.update_document(id=text_type(id), body=text_type(body))
+        writer.commit()
+        self.indexed(batch)
+
+    def terms(self, text):
+        return set(token.text for token in self.schema['body'].analyzer(text_type(text)))
+
+    def query_terms(self, query):
+        from whoosh.qparser import QueryParser
+        from whoosh.query import Term
+        leaves = list(QueryParser('body', self.schema).parse(query).leaves())
+        if not all(isinstance(leaf, Term) for leaf in leaves):
+            # wildcards, ranges, phrases...
+            return None
+        return set(leaf.text for leaf in leaves)
+
+    def search(self, query, limit):
+        from whoosh.qparser import QueryParser
+        with self.index.searcher() as searcher:
+            hits = searcher.search(QueryParser('body', self.schema).parse(query), limit=limit)
+            return [int(hit['id']) for hit in hits]
+
+    def reindex(self, batch_size=1000):
+        from whoosh.writing import CLEAR
+        self.queue.flush()
+        writer = self.index.writer()
+        count = 0
+        for post in Post.query.order_by(Post.id).yield_per(batch_size):
+            writer.add_document(id=text_type(post.id), body=text_type(post.body))
+            count += 1
+        # CLEAR drops the existing segments instead of merging with them
+        writer.commit(mergetype=CLEAR)
+        self.cache.clear()
+        return count
+
+    def stats(self):
+        stats = self.queue.stats()
+        stats['cached_queries'] = len(self.cache)
+        return stats
+
+
+BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'whoosh': WhooshBackend,
+}
+
+
+_lock = Lock()
+
+
+def init_search(app):
+    """Set up the search of ``app``. The backend itself is only created
+    when first needed, see :func:`get_backend`."""
+    BACKENDS[app.config['SEARCH_BACKEND']].listen_schema()
+    models_committed.connect(_committed, sender=app)
+
+
+def get_backend(app=None):
+    """The search backend of ``app``, the current application by default."""
+    if app is None:
+        app = current_app._get_current_object()
+    backend = app.extensions.get('search')
+    if backend is None:
+        with _lock:
+            backend = app.extensions.get('search')
+            if backend is None:
+                backend = BACKENDS[app.config['SEARCH_BACKEND']](app)
+                app.extensions['search'] = backend
+    return backend
+
+
+def _committed(app, changes):
+    if 'search' not in app.extensions and BACKENDS[app.config['SEARCH_BACKEND']].transactional:
+        # the database indexed the posts, and nothing was cached yet
+        return
+    get_backend(app)._committed(app, changes)
+
+
+def search_ids(query, limit):
+    """Return the ids of at most ``limit`` posts matching ``query``, best
+    match first."""
+    return get_backend().search_ids(query, limit)
+
+
+def search_posts(query, limit):
+    """Return at most ``limit`` posts matching ``query``, best match first."""
+    return get_backend().search_posts(query, limit)
@@ -0,0 +1,16 @@
+// Keeps the <time data-format> elements written by the server (see
+// app/momentjs.py) up to date, with moment.js.
+(function () {
+  function refresh() {
+    var times = document.querySelectorAll('time[data-format]');
+    for (var i = 0; i < times.length; i++) {
+      var time = times[i];
+      var when = moment(time.getAttribute('datetime'));
+      var format = time.getAttribute('data-format');
+      time.textContent = format === 'format' ?
+        when.format(time.getAttribute('data-pattern')) : when[format]();
+    }
+  }
+  refresh();
+  setInterval(refresh, 60 * 1000);
+})();
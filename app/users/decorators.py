@@ -1,8 +1,10 @@
 from functools import wraps
 
-from flask import g, flash, redirect, url_for, request
+from flask import g, flash, redirect, url_for, request, abort
 from flask.ext.babel import gettext
 
+from app.users import constants as USER
+
 
 def requires_login(f):
     @wraps(f)
@@ -12,3 +14,14 @@ def requires_login(f):
             return redirect(url_for('users.login', next=request.path))
         return f(*args, **kwargs)
     return decorated_function
+
+
+def requires_admin(f):
+    """Like :func:`requires_login`, but only lets administrators in."""
+    @wraps(f)
+    @requires_login
+    def decorated_function(*args, **kwargs):
+        if g.user.role != USER.ADMIN:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
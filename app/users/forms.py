@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from flask.ext.wtf import Form, RecaptchaField
-from flask.ext.babel import gettext
+from flask.ext.babel import gettext, lazy_gettext
 from wtforms import StringField, TextField, PasswordField, BooleanField
 from wtforms.validators import Required, EqualTo, Email
 
@@ -9,25 +9,25 @@ from app.users.models import User
 
 
 class LoginForm(Form):
-    email = TextField(gettext('Email address'), [Required(), Email()])
-    password = PasswordField(gettext('Password'), [Required()])
+    email = TextField(lazy_gettext('Email address'), [Required(), Email()])
+    password = PasswordField(lazy_gettext('Password'), [Required()])
 
 
 class RegisterForm(Form):
-    name = TextField(gettext('NickName'), [Required()])
-    email = TextField(gettext('Email address'), [Required(), Email()])
-    password = PasswordField(gettext('Password'), [Required()])
-    confirm = PasswordField(gettext('Repeat Password'), [
+    name = TextField(lazy_gettext('NickName'), [Required()])
+    email = TextField(lazy_gettext('Email address'), [Required(), Email()])
+    password = PasswordField(lazy_gettext('Password'), [Required()])
+    confirm = PasswordField(lazy_gettext('Repeat Password'), [
         Required(),
-        EqualTo('password', message=gettext('Passwords must match'))
+        EqualTo('password', message=lazy_gettext('Passwords must match'))
     ])
-    accept_tos = BooleanField(gettext('I accept the TOS'), [Required()])
+    accept_tos = BooleanField(lazy_gettext('I accept the TOS'), [Required()])
     recaptcha = RecaptchaField()
 
 
 class EditForm(Form):
-    name = StringField(gettext('Name'), [Required()])
-    about_me = TextField(gettext('About me'), [Required()])
+    name = StringField(lazy_gettext('Name'), [Required()])
+    about_me = TextField(lazy_gettext('About me'), [Required()])
 
     def __init__(self, original_name, *args, **kwargs):
         Form.__init__(self, *args, **kwargs)
@@ -49,8 +49,8 @@ class EditForm(Form):
 
 
 class PostForm(Form):
-    post = StringField(gettext('post'), validators=[Required()])
+    post = StringField(lazy_gettext('post'), validators=[Required()])
 
 
 class SearchForm(Form):
-    search = StringField(gettext('search'), validators=[Required()])
+    search = StringField(lazy_gettext('search'), validators=[Required()])
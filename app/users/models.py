@@ -1,21 +1,38 @@
 import sys, re
 from hashlib import md5
 
-from app import app, db
+from flask import current_app
+from sqlalchemy import select, literal, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+
+from app import db
+from app.pagination import paginate_keyset
 from app.users import constants as USER
 
 
 followers = db.Table('followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('users_user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('users_user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('users_user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('users_user.id'), primary_key=True),
+    db.Index('followers_followed_idx', 'followed_id', 'follower_id')
+)
+
+# ids per query when resolving follow relationships in bulk, below
+# SQLite's limit of 999 bound parameters
+RELATIONSHIP_BATCH_SIZE = 500
+
+# materialized home timelines: one row per (reader, post), filled on write
+timeline = db.Table('users_timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('users_user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('users_post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime),
+    db.Index('users_timeline_user_timestamp_idx', 'user_id', 'timestamp', 'post_id')
 )
 
 
 if sys.version_info >= (3, 0):
-    enable_search = False
-else:
-    enable_search = True
-    import flask.ext.whooshalchemy as whooshalchemy
+    unichr = chr
 
 class User(db.Model):
     __tablename__ = 'users_user'
@@ -28,6 +45,10 @@ class User(db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    # denormalized counts, see reconcile_counters()
+    followers_count = db.Column(db.Integer, default=0)
+    following_count = db.Column(db.Integer, default=0)
+    posts_count = db.Column(db.Integer, default=0)
     followed = db.relationship('User',
         secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -55,34 +76,202 @@ class User(db.Model):
         return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % (
             md5(self.email.encode('utf-8')).hexdigest(), size)
 
+    def relationship_map(self, users):
+        """Map the ids of ``users`` (users or ids) to whether we follow
+        them, resolving the ones not seen yet in a single query.
+
+        The answers are kept on this instance, so they live as long as the
+        session it belongs to, usually the current request.
+        """
+        ids = set(getattr(user, 'id', user) for user in users)
+        known = self.__dict__.setdefault('_relationships', {})
+        missing = [id for id in ids if id not in known]
+        for start in range(0, len(missing), RELATIONSHIP_BATCH_SIZE):
+            batch = missing[start:start + RELATIONSHIP_BATCH_SIZE]
+            followed = set(id for (id,) in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id).filter(followers.c.followed_id.in_(batch)))
+            for id in batch:
+                known[id] = id in followed
+        return dict((id, known[id]) for id in ids)
+
+    def following_set(self, users):
+        """The ids of the ``users`` (users or ids) we follow."""
+        return set(id for id, following in self.relationship_map(users).items() if following)
+
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return self.relationship_map([user])[user.id]
+
+    def _set_following(self, user, following):
+        self.__dict__.setdefault('_relationships', {})[user.id] = following
 
     def follow(self, user):
-        if not self.is_following(user):
-            self.followed.append(user)
+        if self.id is None or user.id is None:
+            db.session.flush()
+        # the primary key makes a second follow a no-op, no need to look first
+        inserted = insert_ignoring_conflicts(followers, follower_id=self.id, followed_id=user.id)
+        self._set_following(user, True)
+        if inserted:
+            increment_counter(self, 'following_count', 1)
+            increment_counter(user, 'followers_count', 1)
+            self._timeline_add(user)
             return self
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.followed.remove(user)
+        result = db.session.execute(followers.delete().where(
+            followers.c.follower_id == self.id).where(followers.c.followed_id == user.id))
+        self._set_following(user, False)
+        if result.rowcount:
+            increment_counter(self, 'following_count', -1)
+            increment_counter(user, 'followers_count', -1)
+            self._timeline_remove(user)
             return self
 
     def followed_posts(self):
-        return Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(
-            followers.c.follower_id == self.id).order_by(Post.timestamp.desc())
+        # the authors are rendered next to every post, load them in the same query
+        return self._followed(Post.query.options(db.joinedload('author')))
+
+    def followed_post_versions(self):
+        """:meth:`followed_posts` as :meth:`Post.versions` rows, ordered the
+        same way, without loading the posts."""
+        if current_app.config.get('TIMELINE_ENABLED'):
+            id, timestamp = timeline.c.post_id, timeline.c.timestamp
+        else:
+            id, timestamp = Post.id, Post.timestamp
+        return self._followed(Post.query.join(Post.author).with_entities(
+            id.label('id'), timestamp.label('timestamp'), *_AUTHOR_VERSION))
+
+    def _followed(self, query):
+        if current_app.config.get('TIMELINE_ENABLED'):
+            return query.join(timeline, (timeline.c.post_id == Post.id)).filter(
+                timeline.c.user_id == self.id).order_by(
+                timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+        return query.join(followers, (followers.c.followed_id == Post.user_id)).filter(
+            followers.c.follower_id == self.id).order_by(Post.timestamp.desc(), Post.id.desc())
+
+    def followed_posts_page(self, cursor, per_page):
+        """Cursor based page of :meth:`followed_posts`, see
+        :func:`app.pagination.paginate_keyset`."""
+        return self._followed_page(self.followed_posts(), cursor, per_page)
+
+    def followed_versions_page(self, cursor, per_page):
+        """The same page as :meth:`followed_posts_page`, of
+        :meth:`followed_post_versions`."""
+        return self._followed_page(self.followed_post_versions(), cursor, per_page)
+
+    def _followed_page(self, query, cursor, per_page):
+        if current_app.config.get('TIMELINE_ENABLED'):
+            keys = (timeline.c.timestamp, timeline.c.post_id)
+        else:
+            keys = (Post.timestamp, Post.id)
+        return paginate_keyset(query, keys[0], keys[1], cursor, per_page)
+
+    def _timeline_add(self, user):
+        """Copy the most recent posts of ``user`` into our timeline."""
+        if not current_app.config.get('TIMELINE_ENABLED'):
+            return
+        recent = select([literal(self.id), Post.id, Post.timestamp]).where(
+            Post.user_id == user.id).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_LENGTH'])
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], recent))
+        trim_timelines([self.id])
+
+    def _timeline_remove(self, user):
+        """Drop the posts of ``user`` from our timeline."""
+        if not current_app.config.get('TIMELINE_ENABLED'):
+            return
+        authored = select([Post.id]).where(Post.user_id == user.id)
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == self.id).where(timeline.c.post_id.in_(authored)))
+
+    def rebuild_timeline(self):
+        """Recompute our timeline from scratch out of the followers table."""
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id))
+        recent = select([literal(self.id), Post.id, Post.timestamp]).select_from(
+            Post.__table__.join(followers, followers.c.followed_id == Post.user_id)).where(
+            followers.c.follower_id == self.id).order_by(Post.timestamp.desc()).limit(
+            current_app.config['TIMELINE_LENGTH'])
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], recent))
+
+    @staticmethod
+    def rebuild_timelines(batch_size=500):
+        """Backfill every user's timeline, committing every ``batch_size`` users."""
+        count = 0
+        for (user_id,) in db.session.query(User.id).order_by(User.id).all():
+            User.query.get(user_id).rebuild_timeline()
+            count += 1
+            if count % batch_size == 0:
+                db.session.commit()
+        db.session.commit()
+        return count
+
+    @staticmethod
+    def reconcile_counters():
+        """Recompute the denormalized counters of every user from the
+        followers and users_post tables, return the number of users fixed."""
+        users = User.__table__
+        posts = Post.__table__
+        actual = {
+            'followers_count': select([func.count()]).where(
+                followers.c.followed_id == users.c.id).as_scalar(),
+            'following_count': select([func.count()]).where(
+                followers.c.follower_id == users.c.id).as_scalar(),
+            'posts_count': select([func.count()]).where(
+                posts.c.user_id == users.c.id).as_scalar(),
+        }
+        drifted = or_(*[func.coalesce(users.c[column], -1) != count
+                        for column, count in actual.items()])
+        result = db.session.execute(users.update().where(drifted).values(actual))
+        db.session.commit()
+        return result.rowcount
 
     @staticmethod
     def make_unique_name(name):
-        if User.query.filter_by(name=name).first() is None:
+        """Return ``name``, or ``name`` followed by the first free number
+        from 2 up, looking up every taken variant in a single query. An
+        empty ``name`` (nothing valid was typed) stands for 'user'."""
+        name = name or 'user'
+        # a range on the unique index of name, unlike LIKE 'name%'
+        query = db.session.query(User.name).filter(User.name >= name).filter(
+            User.name < name[:-1] + unichr(ord(name[-1]) + 1))
+        suffix = re.compile(re.escape(name) + r'([1-9][0-9]*)$')
+        taken = set()
+        for (other,) in query:
+            if other == name:
+                taken.add(1)
+            else:
+                match = suffix.match(other)
+                if match:
+                    taken.add(int(match.group(1)))
+        if 1 not in taken:
             return name
         version = 2
-        while True:
-            new_name = name + str(version)
-            if User.query.filter_by(name=new_name).first() is None:
-                break
+        while version in taken:
             version += 1
-        return new_name
+        return name + str(version)
+
+    @staticmethod
+    def create(name, email, password, attempts=5):
+        """Insert and commit a new user named after the first free variant
+        of ``name``.
+
+        A concurrent registration can take that variant between the lookup
+        and the INSERT; the unique constraint then fails and the next free
+        variant is tried.
+        """
+        for attempt in range(attempts):
+            user = User(name=User.make_unique_name(name), email=email, password=password)
+            db.session.add(user)
+            try:
+                db.session.commit()
+                return user
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == attempts - 1 or \
+                        User.query.filter_by(name=user.name).first() is None:
+                    # out of attempts, or another column (the email) clashed
+                    raise
 
     @staticmethod
     def make_valid_name(name):
@@ -94,6 +283,11 @@ class User(db.Model):
 
 class Post(db.Model):
     __tablename__ = 'users_post'
+    __table_args__ = (
+        # back the (timestamp, id) keyset pagination of timelines
+        db.Index('users_post_user_timestamp_idx', 'user_id', 'timestamp', 'id'),
+        db.Index('users_post_timestamp_idx', 'timestamp', 'id'),
+    )
     __searchable__ = ['body']
 
     id = db.Column(db.Integer, primary_key=True)
@@ -101,9 +295,133 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('users_user.id'))
 
+    def publish(self):
+        """Store a new post: count it and push it to the followers' timelines."""
+        db.session.add(self)
+        db.session.flush()
+        increment_counter(self.author, 'posts_count', 1)
+        self.fan_out()
+
+    @staticmethod
+    def versions(ids):
+        """``(id, timestamp, author_name, author_email)`` rows of the posts
+        ``ids``, in that order: all their rendering depends on, at a
+        fraction of the cost of loading them."""
+        if not ids:
+            return []
+        rows = Post.query.join(Post.author).with_entities(
+            Post.id, Post.timestamp, *_AUTHOR_VERSION).filter(Post.id.in_(ids)).all()
+        rank = dict((id, i) for i, id in enumerate(ids))
+        return sorted(rows, key=lambda row: rank[row.id])
+
+    @staticmethod
+    def load(ids):
+        """The posts ``ids`` and their authors, in that order."""
+        if not ids:
+            return []
+        posts = Post.query.filter(Post.id.in_(ids)).options(db.joinedload('author')).all()
+        rank = dict((id, i) for i, id in enumerate(ids))
+        return sorted(posts, key=lambda post: rank[post.id])
+
+    def fan_out(self):
+        """Push this post into the timeline of every follower of its author."""
+        if not current_app.config.get('TIMELINE_ENABLED'):
+            return
+        entries = select([followers.c.follower_id, literal(self.id), literal(self.timestamp)]).where(
+            followers.c.followed_id == self.user_id)
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'], entries))
+        # trimming costs a scan of each reader's timeline, so only do it for
+        # one post in TIMELINE_TRIM_EVERY; reads are unaffected by the slack
+        if self.id % current_app.config['TIMELINE_TRIM_EVERY'] == 0:
+            trim_timelines(select([followers.c.follower_id]).where(
+                followers.c.followed_id == self.user_id))
+
     def __repr__(self):
         return '<Post %r>' % self.body
 
 
-if enable_search:
-    whooshalchemy.whoosh_index(app, Post)
+# the author columns shown next to a post
+_AUTHOR_VERSION = (User.name.label('author_name'), User.email.label('author_email'))
+
+
+class FollowEvent(db.Model):
+    """A follow waiting to be announced in the next follower digest."""
+    __tablename__ = 'users_follow_event'
+
+    id = db.Column(db.Integer, primary_key=True)
+    followed_id = db.Column(db.Integer, db.ForeignKey('users_user.id'), index=True)
+    follower_id = db.Column(db.Integer, db.ForeignKey('users_user.id'))
+    timestamp = db.Column(db.DateTime)
+    followed = db.relationship('User', foreign_keys=[followed_id])
+    follower = db.relationship('User', foreign_keys=[follower_id])
+
+    def __repr__(self):
+        return '<FollowEvent %r -> %r>' % (self.follower_id, self.followed_id)
+
+
+# the databases insert_or_ignore() works with
+IGNORING_DIALECTS = ('sqlite', 'mysql', 'postgresql')
+
+
+class InsertOrIgnore(Insert):
+    pass
+
+
+@compiles(InsertOrIgnore)
+def _compile_insert_or_ignore(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs)
+
+
+@compiles(InsertOrIgnore, 'postgresql')
+def _compile_insert_or_ignore_postgresql(insert, compiler, **kwargs):
+    return compiler.visit_insert(insert, **kwargs) + ' ON CONFLICT DO NOTHING'
+
+
+def insert_or_ignore(table):
+    """An INSERT into ``table`` that skips rows conflicting with a unique
+    constraint instead of failing, on the IGNORING_DIALECTS."""
+    return InsertOrIgnore(table).prefix_with('OR IGNORE', dialect='sqlite').prefix_with(
+        'IGNORE', dialect='mysql')
+
+
+def insert_ignoring_conflicts(table, **values):
+    """Insert a row of ``values`` into ``table`` in the current session
+    unless it conflicts with a unique constraint, return whether it was.
+
+    Databases that cannot skip the row themselves try it in a savepoint.
+    """
+    statement = table.insert().values(**values)
+    if db.session.get_bind(clause=statement).dialect.name in IGNORING_DIALECTS:
+        return db.session.execute(insert_or_ignore(table).values(**values)).rowcount > 0
+    try:
+        with db.session.begin_nested():
+            db.session.execute(statement)
+    except IntegrityError:
+        return False
+    return True
+
+
+def increment_counter(user, column, delta):
+    """Atomically add ``delta`` to a counter column of ``user`` as part of
+    the current transaction."""
+    users = User.__table__
+    db.session.execute(users.update().where(users.c.id == user.id).values(
+        {column: users.c[column] + delta}))
+    if user in db.session:
+        db.session.expire(user, [column])
+
+
+def trim_timelines(user_ids):
+    """Cut the timelines of ``user_ids`` (a list or a select) down to
+    TIMELINE_LENGTH entries, dropping the oldest ones."""
+    length = current_app.config['TIMELINE_LENGTH']
+    overflowing = db.session.query(timeline.c.user_id).filter(
+        timeline.c.user_id.in_(user_ids)).group_by(timeline.c.user_id).having(
+        func.count() > length).all()
+    for (user_id,) in overflowing:
+        cutoff = db.session.query(timeline.c.timestamp).filter(
+            timeline.c.user_id == user_id).order_by(
+            timeline.c.timestamp.desc()).offset(length - 1).limit(1).scalar()
+        db.session.execute(timeline.delete().where(
+            timeline.c.user_id == user_id).where(timeline.c.timestamp < cutoff))
@@ -0,0 +1,86 @@
+import unittest
+
+from flask import _app_ctx_stack
+from sqlalchemy import event, orm
+
+from app import create_app, db
+from app.database import RoutingSession
+
+# the application of every test
+app = create_app()
+
+# the in-memory engine holding the schema of TransactionTestCase
+_engine = None
+
+
+def _create_schema(engine):
+    # pysqlite only begins transactions before INSERT, UPDATE and DELETE,
+    # which breaks SAVEPOINT: let SQLAlchemy begin them
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.execute('BEGIN')
+
+    db.create_all()
+
+
+def is_savepoint(statement):
+    """Whether ``statement`` is part of the bookkeeping of
+    :class:`TransactionTestCase` rather than of the code under test."""
+    return statement.lstrip().upper().startswith(
+        ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT'))
+
+
+class TransactionTestCase(unittest.TestCase):
+    """Runs every test in a transaction rolled back afterwards, on an
+    in-memory database whose schema is only created once.
+
+    The session commits of the code under test release a savepoint, and
+    its rollbacks go back to the last one. Tests needing real commits, or
+    several connections, use a database file instead.
+    """
+
+    config = {
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        'LAST_SEEN_FLUSH_INTERVAL': 0,
+    }
+
+    def setUp(self):
+        global _engine
+        app.config.update(self.config)
+        self.context = app.app_context()
+        self.context.push()
+        # a new engine is a new, empty, database
+        if db.engine is not _engine:
+            _create_schema(db.engine)
+            _engine = db.engine
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        self.session = db.session
+        db.session = orm.scoped_session(self.create_session,
+                                        scopefunc=_app_ctx_stack.__ident_func__)
+
+    def tearDown(self):
+        db.session.remove()
+        db.session = self.session
+        self.transaction.rollback()
+        self.connection.close()
+        self.context.pop()
+
+    def create_session(self):
+        session = RoutingSession(db, bind=self.connection,
+                                 binds=dict.fromkeys(db.metadata.sorted_tables, self.connection))
+        session.begin_nested()
+
+        @event.listens_for(session, 'after_transaction_end')
+        def restart_savepoint(session, transaction):
+            if transaction.nested and not transaction._parent.nested:
+                session.expire_all()
+                session.begin_nested()
+
+        return session
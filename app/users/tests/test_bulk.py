@@ -0,0 +1,99 @@
+import os
+import unittest
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+
+from config import _basedir
+from app import db
+from app.users.tests import app
+from app.bulk import export, load, _reset_sequences
+from app.search import get_backend, search_posts
+from app.users.models import User, Post, followers
+
+try:
+    from StringIO import StringIO  # python 2
+except ImportError:
+    from io import StringIO  # python 3
+
+
+class BulkTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_basedir, 'test.db')
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        get_backend(app).cache.clear()
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def dump(self):
+        return dict((table.name, sorted(tuple(row) for row in db.session.execute(table.select())))
+                    for table in (User.__table__, followers, Post.__table__))
+
+    def test_round_trip(self):
+        users = [User(name='user%d' % i, email='user%d@sugarlady.com' % i) for i in range(5)]
+        db.session.add_all(users)
+        db.session.flush()
+        for user in users:
+            users[0].follow(user)
+            Post(body='cats of %s' % user.name, author=user,
+                 timestamp=datetime(2015, 1, 1, 12, 30, 15, 250)).publish()
+        db.session.commit()
+        first = users[0].id
+        before = self.dump()
+
+        output = StringIO()
+        report = export(output, chunk_size=2)
+        self.assertEqual(report.rows, {'users_user': 5, 'followers': 5, 'users_post': 5})
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        inserts = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT'):
+                inserts.append(len(parameters) if executemany else 1)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            report = load(StringIO(output.getvalue()), chunk_size=2, transaction_size=4)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        # chunks of at most 2 rows, never mixing tables
+        self.assertEqual(inserts, [2, 2, 1] * 3)
+        self.assertEqual(report.rows, {'users_user': 5, 'followers': 5, 'users_post': 5})
+        self.assertEqual(self.dump(), before)
+        self.assertEqual(User.query.get(first).following_count, 5)
+        self.assertEqual(len(search_posts('cats', 10)), 5)
+        # new rows get new ids
+        user = User(name='late', email='late@sugarlady.com')
+        db.session.add(user)
+        db.session.flush()
+        post = Post(body='late cats', author=user, timestamp=datetime.utcnow())
+        post.publish()
+        db.session.commit()
+        self.assertEqual(user.id, max(row[0] for row in before['users_user']) + 1)
+        self.assertEqual(post.id, max(row[0] for row in before['users_post']) + 1)
+
+    def test_postgresql_sequences_follow_the_import(self):
+        class Connection(object):
+            dialect = postgresql.dialect()
+            statements = []
+
+            def execute(self, statement):
+                self.statements.append(statement)
+
+        connection = Connection()
+        _reset_sequences(connection, [User.__table__, followers, Post.__table__])
+        self.assertEqual(len(connection.statements), 2)
+        self.assertIn("pg_get_serial_sequence('users_user', 'id')", connection.statements[0])
+        self.assertIn("FROM users_post", connection.statements[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import session
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from config import _basedir
+from app import db
+from app.users.tests import app
+from app.users.models import User
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_basedir, 'test.db')
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_sqlite_connections(self):
+        self.assertTrue(isinstance(db.engine.pool, QueuePool))
+        connection = db.engine.connect()
+        try:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.execute('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(connection.execute('PRAGMA busy_timeout').scalar(), 5000)
+        finally:
+            connection.close()
+        # engines not created by the application are left alone
+        other = create_engine('sqlite:///' + os.path.join(_basedir, 'test.db'))
+        try:
+            self.assertEqual(other.execute('PRAGMA synchronous').scalar(), 2)
+        finally:
+            other.dispose()
+
+    def test_readers_do_not_wait_for_writers(self):
+        db.session.add(User(name='mark', email='mark@sugarlady.com'))
+        db.session.commit()
+        writer = db.engine.raw_connection()
+        try:
+            # locks out readers for busy_timeout, then fails, with a rollback journal
+            writer.execute('BEGIN EXCLUSIVE')
+            writer.execute("UPDATE users_user SET about_me = 'writing'")
+            self.assertEqual(User.query.one().about_me, None)
+        finally:
+            writer.rollback()
+            writer.close()
+
+    def test_forked_process_opens_its_own_connections(self):
+        connection = db.engine.connect()
+        inherited = connection.connection.connection
+        record = connection.connection._connection_record
+        connection.close()
+        # as seen from a forked worker
+        record.info['pid'] = -1
+        connection = db.engine.connect()
+        try:
+            self.assertIsNot(connection.connection.connection, inherited)
+            self.assertEqual(connection.execute('SELECT 1').scalar(), 1)
+        finally:
+            connection.close()
+            inherited.close()
+
+class ReplicaTestCase(unittest.TestCase):
+    """test.db is the primary, a second SQLite file its replica; they hold
+    different users, to tell where each query went."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_basedir, 'test.db')
+        self.directory = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_REPLICAS'] = ['sqlite:///' + os.path.join(self.directory, 'replica.db')]
+        self.context = app.test_request_context()
+        self.context.push()
+        db.create_all()
+        self.replica, = db.get_replica_engines(app)
+        db.metadata.create_all(self.replica)
+        db.engine.execute(User.__table__.insert(), name='primary')
+        self.replica.execute(User.__table__.insert(), name='replica')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        self.replica.dispose()
+        app.config['SQLALCHEMY_REPLICAS'] = []
+        shutil.rmtree(self.directory)
+
+    def names(self):
+        return sorted(user.name for user in User.query)
+
+    def test_reads_and_writes(self):
+        self.assertEqual(self.names(), ['replica'])
+        self.assertEqual(db.session.execute('SELECT count(*) FROM users_user').scalar(), 1)
+
+        # the session reads its own writes
+        db.session.add(User(name='mark', email='mark@sugarlady.com'))
+        self.assertEqual(self.names(), ['mark', 'primary'])
+        db.session.commit()
+        self.assertEqual(self.names(), ['mark', 'primary'])
+
+        # so do statements, in a new session
+        db.session.remove()
+        db.session.execute(User.__table__.delete().where(User.name == 'mark'))
+        self.assertEqual(self.names(), ['primary'])
+        db.session.commit()
+        self.assertEqual(self.replica.execute('SELECT count(*) FROM users_user').scalar(), 1)
+
+    def test_sticky_reads_after_a_write(self):
+        db.session.add(User(name='mark', email='mark@sugarlady.com'))
+        db.session.commit()
+        self.assertIn('_primary_until', session)
+
+        # the next requests of this user read from the primary for a while
+        db.session.remove()
+        self.assertEqual(self.names(), ['mark', 'primary'])
+        db.session.remove()
+        session['_primary_until'] = 0
+        self.assertEqual(self.names(), ['replica'])
+
+
+if __name__ == '__main__':
+    unittest.main()
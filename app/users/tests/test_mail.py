@@ -0,0 +1,212 @@
+import asyncore
+import os
+import smtpd
+import unittest
+from threading import Thread
+
+from flask.ext.mail import Message
+
+from config import _basedir
+from app import db, mail, mail_queue
+from app.users.tests import app, TransactionTestCase
+from app.emails import follower_notification, send_follower_digests
+from app.mailqueue import _AppMailQueue, _STOP
+from app.users.models import User, FollowEvent
+
+
+class SinkServer(smtpd.SMTPServer):
+    """A local SMTP server keeping the messages it receives."""
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.connections = 0
+        self.messages = []
+        self.running = True
+        self.thread = Thread(target=self.serve)
+        self.thread.start()
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.01, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.close()
+
+
+class MailQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = dict(app.config)
+        self.sink = SinkServer()
+        app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=self.sink.port,
+                          MAIL_USE_SSL=False, MAIL_USE_TLS=False, MAIL_USERNAME=None,
+                          MAIL_SUPPRESS_SEND=False, MAIL_WORKERS=1, MAIL_BATCH_SIZE=50,
+                          MAIL_RETRIES=1, MAIL_RETRY_BACKOFF=0)
+        mail.init_app(app)
+
+    def tearDown(self):
+        self.sink.stop()
+        app.config.clear()
+        app.config.update(self.config)
+        mail.init_app(app)
+
+    def message(self, i):
+        return Message(subject='message %d' % i, sender='admin@sugarlady.com',
+                       recipients=['mark@sugarlady.com'], body='body %d' % i)
+
+    def test_batches_share_a_connection(self):
+        queue = _AppMailQueue(app, mail)
+        for i in range(5):
+            self.assertEqual(queue.put(self.message(i)), True)
+        queue.shutdown()
+        self.assertEqual(queue.sent, 5)
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertTrue(self.sink.connections <= 2)
+
+    def test_forked_process_starts_its_own_workers(self):
+        queue = _AppMailQueue(app, mail)
+        queue.put(self.message(0))
+        queue.join()
+        inherited = queue._queue
+        # as seen from a forked worker
+        queue._pid = -1
+        queue.put(self.message(1))
+        self.assertIsNot(queue._queue, inherited)
+        queue.shutdown()
+        self.assertEqual(queue.sent, 2)
+        self.assertEqual(len(self.sink.messages), 2)
+        # stop the worker of the "parent"
+        inherited.put(_STOP)
+
+    def test_survives_unexpected_errors(self):
+        queue = _AppMailQueue(app, mail)
+        bad = self.message(0)
+        # refused by Flask-Mail with a BadHeaderError, not an SMTPException
+        bad.subject = 'bad\r\nsubject'
+        queue.put(bad)
+        queue.join()
+        queue.put(self.message(1))
+        queue.shutdown()
+        self.assertEqual((queue.sent, queue.failed), (1, 1))
+        self.assertEqual(len(self.sink.messages), 1)
+
+    def test_gives_up_after_retries(self):
+        app.config['MAIL_PORT'] = 1
+        mail.init_app(app)
+        queue = _AppMailQueue(app, mail)
+        queue.put(self.message(0))
+        queue.shutdown()
+        self.assertEqual((queue.sent, queue.failed), (0, 1))
+
+
+class FollowerDigestTestCase(TransactionTestCase):
+    def setUp(self):
+        app.config['FOLLOWER_NOTIFICATIONS'] = 'digest'
+        app.config['MAIL_SUPPRESS_SEND'] = True
+        mail.init_app(app)
+        TransactionTestCase.setUp(self)
+
+    def tearDown(self):
+        app.config['FOLLOWER_NOTIFICATIONS'] = 'immediate'
+        del app.config['MAIL_SUPPRESS_SEND']
+        mail.init_app(app)
+        TransactionTestCase.tearDown(self)
+
+    def test_digest(self):
+        # the mails link to the profiles, which needs a request context
+        with app.test_request_context():
+            users = [User(name=name, email='%s@sugarlady.com' % name)
+                     for name in ('mark', 'rudy', 'jack', 'william')]
+            for user in users:
+                db.session.add(user)
+            db.session.commit()
+            mark, rudy, jack, william = users
+            for follower in (rudy, jack, william):
+                follower.follow(mark)
+                follower_notification(mark, follower)
+            william.follow(rudy)
+            follower_notification(rudy, william)
+            db.session.commit()
+            # undone follows are not announced
+            william.unfollow(mark)
+            db.session.commit()
+            # and follows done again only once
+            jack.unfollow(mark)
+            jack.follow(mark)
+            follower_notification(mark, jack)
+            db.session.commit()
+
+            with mail.record_messages() as outbox:
+                self.assertEqual(send_follower_digests(), 2)
+                mail_queue.join()
+            self.assertEqual(sorted(message.subject for message in outbox),
+                             ['[microblog] 1 new follower', '[microblog] 2 new followers'])
+            self.assertEqual(FollowEvent.query.count(), 0)
+            self.assertEqual(send_follower_digests(), 0)
+
+
+class ImmediateMailTestCase(unittest.TestCase):
+    """The savepoints of TransactionTestCase are not commits: these tests
+    need a database file."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_basedir, 'test.db')
+        app.config['MAIL_SUPPRESS_SEND'] = True
+        mail.init_app(app)
+        # the mails link to the profiles, which needs a request context
+        self.context = app.test_request_context()
+        self.context.push()
+        db.create_all()
+        self.mark = User(name='mark', email='mark@sugarlady.com')
+        self.rudy = User(name='rudy', email='rudy@sugarlady.com')
+        db.session.add_all([self.mark, self.rudy])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        del app.config['MAIL_SUPPRESS_SEND']
+        mail.init_app(app)
+
+    def test_mails_wait_for_the_commit(self):
+        with mail.record_messages() as outbox:
+            self.rudy.follow(self.mark)
+            follower_notification(self.mark, self.rudy)
+            db.session.rollback()
+            self.rudy.follow(self.mark)
+            follower_notification(self.mark, self.rudy)
+            mail_queue.join()
+            self.assertEqual(outbox, [])
+            db.session.commit()
+            mail_queue.join()
+        self.assertEqual(len(outbox), 1)
+        # to the followed user
+        self.assertEqual(outbox[0].recipients, ['mark@sugarlady.com'])
+
+    def test_mails_outlive_savepoints(self):
+        with mail.record_messages() as outbox:
+            self.rudy.follow(self.mark)
+            follower_notification(self.mark, self.rudy)
+            db.session.begin_nested()
+            db.session.rollback()
+            db.session.begin_nested()
+            db.session.commit()
+            mail_queue.join()
+            self.assertEqual(outbox, [])
+            db.session.commit()
+            mail_queue.join()
+        self.assertEqual(len(outbox), 1)
+
+if __name__ == '__main__':
+    unittest.main()
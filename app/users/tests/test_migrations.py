@@ -0,0 +1,58 @@
+import os
+import unittest
+
+from sqlalchemy import create_engine, inspect
+
+from config import _basedir
+from app.migrations import upgrade
+from app.users.tests import app
+
+# the schema created by db.create_all() before the migrations existed
+LEGACY_SCHEMA = [
+    'CREATE TABLE users_user (id INTEGER NOT NULL, name VARCHAR(80), email VARCHAR(120), '
+    'password VARCHAR(120), role SMALLINT, status SMALLINT, about_me VARCHAR(140), '
+    'last_seen DATETIME, PRIMARY KEY (id), UNIQUE (name), UNIQUE (email))',
+    'CREATE TABLE users_post (id INTEGER NOT NULL, body VARCHAR(140), timestamp DATETIME, '
+    'user_id INTEGER, PRIMARY KEY (id))',
+    'CREATE TABLE followers (follower_id INTEGER, followed_id INTEGER)',
+]
+
+
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.filename = os.path.join(_basedir, 'test_migrations.db')
+        self.engine = create_engine('sqlite:///' + self.filename)
+        for statement in LEGACY_SCHEMA:
+            self.engine.execute(statement)
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        self.engine.dispose()
+        os.unlink(self.filename)
+
+    def test_upgrade(self):
+        self.engine.execute("INSERT INTO users_user (id, name) VALUES (1, 'mark'), (2, 'rudy')")
+        self.engine.execute("INSERT INTO users_post (id, body, user_id) VALUES (1, 'hello', 2)")
+        self.engine.execute("INSERT INTO followers VALUES (1, 1), (1, 2), (1, 2)")
+
+        self.assertEqual(upgrade(self.engine), ['followers_primary_key', 'user_counters',
+                                                'missing_indexes', 'search_index'])
+        self.assertEqual(upgrade(self.engine), [])
+
+        inspector = inspect(self.engine)
+        self.assertEqual(inspector.get_pk_constraint('followers')['constrained_columns'],
+                         ['follower_id', 'followed_id'])
+        self.assertIn('followers_followed_idx',
+                      [index['name'] for index in inspector.get_indexes('followers')])
+        self.assertEqual(self.engine.execute('SELECT count(*) FROM followers').scalar(), 2)
+        self.assertEqual(self.engine.execute(
+            'SELECT followers_count, following_count, posts_count FROM users_user '
+            'ORDER BY id').fetchall(), [(1, 2, 0), (1, 0, 1)])
+        self.assertEqual(self.engine.execute(
+            "SELECT rowid FROM users_post_fts WHERE users_post_fts MATCH 'hello'").fetchall(), [(1,)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,21 +2,16 @@ import os
 import unittest
 from datetime import datetime, timedelta
 
-from config import _basedir
-from app import app, db
-from app.users.models import User, Post
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
 
-class UserTestCase(unittest.TestCase):
-    def setUp(self):
-        app.config['TESTING'] = True
-        app.config['WTF_CSRF_ENABLED'] = False
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_basedir, 'test.db')
-        self.app = app.test_client()
-        db.create_all()
+from config import _basedir
+from app import db
+from app.users.tests import app, is_savepoint, TransactionTestCase
+from app.users import models
+from app.users.models import User, Post, followers, insert_or_ignore
 
-    def tearDown(self):
-        db.session.remove()
-        db.drop_all()
+class UserTestCase(TransactionTestCase):
 
     def test_make_unique_name(self):
         user = User(name='john', email='john@sugarlady.com')
@@ -31,6 +26,44 @@ class UserTestCase(unittest.TestCase):
         new_name = User.make_unique_name('john')
         self.assertEqual(new_name, 'john3')
 
+    def test_make_unique_name_single_query(self):
+        for name in ('john', 'john2', 'john4', 'john03', 'johnny', 'john_3', 'jon'):
+            db.session.add(User(name=name, email='%s@sugarlady.com' % name))
+        db.session.commit()
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if not is_savepoint(statement):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertEqual(User.make_unique_name('john'), 'john3')
+            self.assertEqual(User.make_unique_name('johnny'), 'johnny2')
+            self.assertEqual(User.make_unique_name('jo'), 'jo')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(len(statements), 3)
+
+    def test_make_unique_name_empty(self):
+        self.assertEqual(User.make_unique_name(''), 'user')
+        db.session.add(User(name='user', email='user@sugarlady.com'))
+        db.session.commit()
+        self.assertEqual(User.make_unique_name(User.make_valid_name('!!!')), 'user2')
+
+    def test_create_retries_taken_names(self):
+        db.session.add(User(name='john', email='john@sugarlady.com'))
+        db.session.commit()
+        # simulate a concurrent registration taking the name between the
+        # lookup and the insert
+        make_unique_name = User.make_unique_name
+        names = iter(['john', 'john2'])
+        User.make_unique_name = staticmethod(lambda name: next(names))
+        try:
+            user = User.create('john', 'john2@sugarlady.com', 'secret')
+        finally:
+            User.make_unique_name = staticmethod(make_unique_name)
+        self.assertEqual(user.name, 'john2')
+        self.assertEqual(User.query.count(), 2)
+
     def test_follow(self):
         user1 = User(name='mark', email='mark@sugarlady.com')
         user2 = User(name='rudy', email='rudy@sugarlady.com')
@@ -58,6 +91,54 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(user1.followed.count(), 0)
         self.assertEqual(user2.followers.count(), 0)
 
+    def test_follow_twice(self):
+        user1 = User(name='mark', email='mark@sugarlady.com')
+        user2 = User(name='rudy', email='rudy@sugarlady.com')
+        db.session.add_all([user1, user2])
+        db.session.commit()
+        statement = insert_or_ignore(followers).values(follower_id=1, followed_id=2)
+        self.assertTrue(str(statement.compile(dialect=postgresql.dialect())).endswith(
+            ' ON CONFLICT DO NOTHING'))
+
+        # databases which cannot ignore conflicts in the INSERT itself
+        dialects = models.IGNORING_DIALECTS
+        models.IGNORING_DIALECTS = ()
+        try:
+            self.assertEqual(user1.follow(user2), user1)
+            self.assertEqual(user1.follow(user2), None)
+            db.session.commit()
+        finally:
+            models.IGNORING_DIALECTS = dialects
+        self.assertEqual(user1.followed.count(), 1)
+        self.assertEqual(user2.followers_count, 1)
+
+    def test_relationship_map(self):
+        users = [User(name='user%d' % i, email='user%d@sugarlady.com' % i) for i in range(4)]
+        for user in users:
+            db.session.add(user)
+        db.session.commit()
+        db.session.add(users[0].follow(users[1]))
+        db.session.add(users[0].follow(users[3]))
+        db.session.commit()
+
+        reader = User.query.get(users[0].id)
+        db.session.expunge(reader)
+        reader = User.query.get(users[0].id)
+        self.assertEqual(reader.relationship_map(users[1:]),
+                         {users[1].id: True, users[2].id: False, users[3].id: True})
+        self.assertEqual(reader.following_set([users[1].id, users[2].id]), set([users[1].id]))
+        # answered from the cache, without a query
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if not is_savepoint(statement):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self.assertEqual(reader.is_following(users[3]), True)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(statements, [])
+
     def test_followed_posts(self):
         # create 4 users
         user1 = User(name='mark', email='mark@sugarlady.com')
@@ -109,6 +190,107 @@ class UserTestCase(unittest.TestCase):
         self.assertEqual(f3.all(), [post3, post1])
         self.assertEqual(f4.all(), [post4, post3, post1])
 
+    def test_timeline(self):
+        app.config['TIMELINE_ENABLED'] = True
+        app.config['TIMELINE_LENGTH'] = 3
+        app.config['TIMELINE_TRIM_EVERY'] = 1
+        try:
+            user1 = User(name='mark', email='mark@sugarlady.com')
+            user2 = User(name='rudy', email='rudy@sugarlady.com')
+            db.session.add(user1)
+            db.session.add(user2)
+            utcnow = datetime.utcnow()
+            old = Post(body='old post from rudy', author=user2, timestamp=utcnow)
+            db.session.add(old)
+            db.session.commit()
+
+            # following copies the existing posts in
+            db.session.add(user1.follow(user2))
+            db.session.commit()
+            self.assertEqual(user1.followed_posts().all(), [old])
+
+            # new posts are pushed to the followers
+            posts = []
+            for i in range(3):
+                post = Post(body='post %d' % i, author=user2,
+                            timestamp=utcnow + timedelta(seconds=i + 1))
+                post.publish()
+                posts.insert(0, post)
+            db.session.commit()
+            # the timeline is bounded to TIMELINE_LENGTH entries
+            self.assertEqual(user1.followed_posts().all(), posts)
+            self.assertEqual([row.id for row in user1.followed_post_versions()],
+                             [post.id for post in posts])
+
+            user1.rebuild_timeline()
+            db.session.commit()
+            self.assertEqual(user1.followed_posts().all(), posts)
+
+            db.session.add(user1.unfollow(user2))
+            db.session.commit()
+            self.assertEqual(user1.followed_posts().count(), 0)
+        finally:
+            app.config['TIMELINE_ENABLED'] = False
+
+    def test_counters(self):
+        user1 = User(name='mark', email='mark@sugarlady.com')
+        user2 = User(name='rudy', email='rudy@sugarlady.com')
+        db.session.add(user1)
+        db.session.add(user2)
+        db.session.commit()
+        db.session.add(user1.follow(user1))
+        db.session.add(user1.follow(user2))
+        Post(body='post from mark', author=user1, timestamp=datetime.utcnow()).publish()
+        db.session.commit()
+        self.assertEqual((user1.followers_count, user1.following_count, user1.posts_count), (1, 2, 1))
+        self.assertEqual((user2.followers_count, user2.following_count, user2.posts_count), (1, 0, 0))
+
+        db.session.add(user1.unfollow(user2))
+        db.session.commit()
+        self.assertEqual(user1.following_count, 1)
+        self.assertEqual(user2.followers_count, 0)
+
+        # drift is repaired
+        user2.followers_count = 42
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(), 1)
+        self.assertEqual(user2.followers_count, 0)
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_followed_posts_page(self):
+        user1 = User(name='mark', email='mark@sugarlady.com')
+        user2 = User(name='rudy', email='rudy@sugarlady.com')
+        db.session.add(user1)
+        db.session.add(user2)
+        # two posts share a timestamp, the id breaks the tie
+        utcnow = datetime.utcnow()
+        for i in range(7):
+            db.session.add(Post(body='post %d' % i, author=user2,
+                                timestamp=utcnow + timedelta(seconds=i // 2)))
+        db.session.commit()
+        db.session.add(user1.follow(user2))
+        db.session.commit()
+        expected = user1.followed_posts().all()
+
+        pages = [user1.followed_posts_page(None, 3)]
+        while pages[-1].has_next:
+            pages.append(user1.followed_posts_page(pages[-1].next_cursor, 3))
+        self.assertEqual([len(page.items) for page in pages], [3, 3, 1])
+        self.assertEqual(sum([page.items for page in pages], []), expected)
+        self.assertEqual(pages[0].has_prev, False)
+
+        # walking back from the last page gives the same pages
+        newer = user1.followed_posts_page(pages[2].prev_cursor, 3)
+        self.assertEqual(newer.items, pages[1].items)
+        self.assertEqual(newer.has_prev, True)
+        self.assertRaises(ValueError, user1.followed_posts_page, 'garbage', 3)
+
+        # the versions walk the same pages, without loading the posts
+        versions = user1.followed_versions_page(pages[0].next_cursor, 3)
+        self.assertEqual([row.id for row in versions.items], [post.id for post in pages[1].items])
+        self.assertEqual(versions.items[0].author_name, 'rudy')
+        self.assertEqual(Post.load([row.id for row in versions.items]), pages[1].items)
+
 
 if __name__ == '__main__':
     unittest.main()
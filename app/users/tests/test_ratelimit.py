@@ -0,0 +1,101 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from app import db, limiter
+from app.users.tests import app, TransactionTestCase
+from app.ratelimit import MemoryStorage, SQLiteStorage
+from app.users.models import User
+from app.users.tracking import last_seen, user_cache
+
+
+class StorageTestCase(unittest.TestCase):
+    def check_bucket(self, storage):
+        # 2 requests per 10 seconds
+        take = lambda now: storage.take('post:user:1', 0.2, 2, now)
+        self.assertEqual(take(100), 0)
+        self.assertEqual(take(100), 0)
+        self.assertAlmostEqual(take(101), 4)
+        # refilled by one token, which was not spent by the refusal
+        self.assertEqual(take(105), 0)
+        self.assertAlmostEqual(take(105), 5)
+        # never more than the burst
+        self.assertEqual(take(1000), 0)
+        self.assertEqual(take(1000), 0)
+        self.assertAlmostEqual(take(1000), 5)
+        # other clients have their own buckets
+        self.assertEqual(storage.take('post:user:2', 0.2, 2, 1000), 0)
+
+    def test_memory(self):
+        storage = MemoryStorage(maxsize=2)
+        self.check_bucket(storage)
+        # the least recently seen client is forgotten
+        storage.take('post:user:3', 0.2, 2, 1000)
+        self.assertEqual(list(storage._buckets), ['post:user:2', 'post:user:3'])
+
+    def test_sqlite_is_shared(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'ratelimit.db')
+            self.check_bucket(SQLiteStorage(path, 10))
+            # another process sees the same, spent, bucket
+            self.assertAlmostEqual(SQLiteStorage(path, 10).take('post:user:1', 0.2, 2, 1000), 5)
+        finally:
+            shutil.rmtree(directory)
+
+
+class LimitTestCase(TransactionTestCase):
+    def setUp(self):
+        TransactionTestCase.setUp(self)
+        self.limits = app.config['RATELIMITS']
+        app.config['RATELIMITS'] = {'follow': (2, 60)}
+        # forgotten by the flush, so the users of other tests are touched
+        self.interval = app.config['LAST_SEEN_INTERVAL']
+        app.config['LAST_SEEN_INTERVAL'] = 0
+        self.app = app.test_client()
+
+    def tearDown(self):
+        last_seen.flush()
+        app.config['LAST_SEEN_INTERVAL'] = self.interval
+        app.config['RATELIMITS'] = self.limits
+        user_cache.clear()
+        limiter.reset()
+        TransactionTestCase.tearDown(self)
+
+    def test_follow_is_limited(self):
+        users = [User(name=name, email='%s@sugarlady.com' % name) for name in ('mark', 'anna')]
+        db.session.add_all(users)
+        db.session.commit()
+        with self.app.session_transaction() as session:
+            session['user_id'] = users[0].id
+
+        self.assertEqual(self.app.get('/users/follow/anna').status_code, 302)
+        self.assertEqual(self.app.get('/users/unfollow/anna').status_code, 302)
+        response = self.app.get('/users/follow/anna')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '30')
+        # the refused request did nothing
+        db.session.expire_all()
+        self.assertFalse(users[0].is_following(users[1]))
+        # only the limited views count
+        self.assertEqual(self.app.get('/users/mark/').status_code, 200)
+
+    def test_locked_storage_lets_requests_through(self):
+        directory = tempfile.mkdtemp()
+        storage = app.extensions['ratelimit']
+        try:
+            path = os.path.join(directory, 'ratelimit.db')
+            app.extensions['ratelimit'] = SQLiteStorage(path, 60, timeout=0)
+            limiter.storage.clear()
+            # another worker holding the lock
+            other = sqlite3.connect(path, isolation_level=None)
+            other.execute('BEGIN IMMEDIATE')
+            with app.test_request_context():
+                self.assertEqual(limiter.hit('follow', 'user:1'), 0)
+            other.execute('ROLLBACK')
+            other.close()
+        finally:
+            app.extensions['ratelimit'] = storage
+            shutil.rmtree(directory)
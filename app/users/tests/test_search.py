@@ -0,0 +1,204 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects import postgresql
+
+from config import _basedir
+from app import db
+from app.users.tests import app, TransactionTestCase
+from app.search import get_backend, search_posts
+from app.users import constants as USER
+from app.users.models import User, Post
+from app.users.tracking import last_seen, user_cache
+
+
+class SearchTestCase(TransactionTestCase):
+    def tearDown(self):
+        get_backend(app).cache.clear()
+        TransactionTestCase.tearDown(self)
+
+    def test_search_posts(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        utcnow = datetime.utcnow()
+        bodies = ['I like cats', 'Dogs are better than cats, cats cats', 'Nothing to see']
+        posts = [Post(body=body, author=user, timestamp=utcnow + timedelta(seconds=i))
+                 for i, body in enumerate(bodies)]
+        for post in posts:
+            db.session.add(post)
+        db.session.commit()
+
+        # ranked, stemmed, and the authors come along
+        self.assertEqual(search_posts('cat', 10), [posts[1], posts[0]])
+        self.assertEqual(search_posts('cats', 1), [posts[1]])
+        self.assertEqual(search_posts('like cats', 10), [posts[0]])
+        self.assertEqual(search_posts('cats', 10)[0].__dict__['author'], user)
+        # user input is never parsed as FTS5 syntax
+        self.assertEqual(search_posts('"cats" OR NEAR(*', 10), [])
+        self.assertEqual(search_posts('  ', 10), [])
+
+        # the index follows the posts
+        posts[2].body = 'cats everywhere'
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertEqual(set(search_posts('cats', 10)), set([posts[1], posts[2]]))
+
+    def test_cache(self):
+        backend = get_backend(app)
+        user = User(name='mark', email='mark@sugarlady.com')
+        cats = Post(body='I like cats', author=user, timestamp=datetime.utcnow())
+        dogs = Post(body='I like dogs', author=user, timestamp=datetime.utcnow())
+        db.session.add_all([cats, dogs])
+        db.session.commit()
+
+        calls = []
+        search = backend.search
+        backend.search = lambda query, limit: calls.append(query) or search(query, limit)
+        try:
+            self.assertEqual(search_posts('cats', 10), [cats])
+            self.assertEqual(search_posts('  CATS ', 10), [cats])
+            self.assertEqual(search_posts('dog', 10), [dogs])
+            self.assertEqual(calls, ['cats', 'dog'])
+
+            # a new post about cats only drops the cached cat search
+            new = Post(body='Cat pictures', author=user, timestamp=datetime.utcnow())
+            db.session.add(new)
+            db.session.commit()
+            self.assertEqual(set(search_posts('cats', 10)), set([cats, new]))
+            self.assertEqual(search_posts('dog', 10), [dogs])
+            self.assertEqual(calls, ['cats', 'dog', 'cats'])
+
+            # so does editing a post listed in the results
+            dogs.body = 'I like birds'
+            db.session.commit()
+            self.assertEqual(search_posts('dog', 10), [])
+            self.assertEqual(calls, ['cats', 'dog', 'cats', 'dog'])
+        finally:
+            del backend.search
+
+    def test_cache_follows_the_tokenizer(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        db.session.commit()
+        # short stems, and accents, defeat any guess on the spelling
+        self.assertEqual(search_posts('go', 10), [])
+        self.assertEqual(search_posts('ecole', 10), [])
+        posts = [Post(body=u'Going home', author=user, timestamp=datetime.utcnow()),
+                 Post(body=u'Back to \xe9cole', author=user, timestamp=datetime.utcnow())]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.assertEqual(search_posts('go', 10), [posts[0]])
+        self.assertEqual(search_posts('ecole', 10), [posts[1]])
+
+    def test_sqlite_backend_needs_sqlite(self):
+        class Connection(object):
+            dialect = postgresql.dialect()
+
+            def execute(self, statement):
+                raise AssertionError(statement)
+
+        # a clear error, not FTS5 statements failing on another database
+        self.assertRaises(RuntimeError, get_backend(app).install, Connection())
+
+
+class WhooshTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(_basedir, 'test.db')
+        self.context = app.app_context()
+        self.context.push()
+        db.create_all()
+        self.whoosh_base = tempfile.mkdtemp()
+        app.config['WHOOSH_BASE'] = self.whoosh_base
+        # never written by the background thread during the test
+        app.config['SEARCH_INDEX_MAX_STALENESS'] = 3600
+        app.config['SEARCH_BACKEND'] = 'whoosh'
+        self.sqlite = app.extensions.pop('search', None)
+        self.backend = get_backend(app)
+
+    def tearDown(self):
+        self.backend.close()
+        app.config['SEARCH_BACKEND'] = 'sqlite'
+        if self.sqlite is None:
+            del app.extensions['search']
+        else:
+            app.extensions['search'] = self.sqlite
+        shutil.rmtree(self.whoosh_base)
+        app.config['WHOOSH_BASE'] = os.path.join(_basedir, 'search.db')
+        app.config['SEARCH_INDEX_MAX_STALENESS'] = 5
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def test_batched_indexing(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        posts = [Post(body='I like cats', author=user, timestamp=datetime.utcnow()),
+                 Post(body='dogs', author=user, timestamp=datetime.utcnow())]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        # committed, but not indexed yet
+        self.assertEqual(self.backend.stats()['pending'], 2)
+        self.assertEqual(self.backend.search('cat', 10), [])
+        self.backend.queue.flush()
+        self.assertEqual(self.backend.search('cat', 10), [posts[0].id])
+        self.assertEqual(self.backend.stats()['pending'], 0)
+        self.assertEqual(self.backend.stats()['indexed'], 2)
+
+        # changes of a post collapse into one update
+        posts[1].body = 'cats'
+        db.session.commit()
+        posts[1].body = 'more cats'
+        db.session.commit()
+        db.session.delete(posts[0])
+        db.session.commit()
+        self.assertEqual(self.backend.stats()['pending'], 2)
+        self.backend.queue.flush()
+        self.assertEqual(self.backend.search('cat', 10), [posts[1].id])
+        self.assertEqual(self.backend.stats()['batches'], 2)
+
+    def test_stats_of_the_serving_process(self):
+        admin = User(name='mark', email='mark@sugarlady.com')
+        admin.role = USER.ADMIN
+        db.session.add(admin)
+        db.session.add(Post(body='I like cats', author=admin, timestamp=datetime.utcnow()))
+        db.session.commit()
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = admin.id
+        # the touch of the admin is forgotten by the flush, so the users of
+        # other tests are touched
+        intervals = app.config['LAST_SEEN_INTERVAL'], app.config['LAST_SEEN_FLUSH_INTERVAL']
+        app.config.update(LAST_SEEN_INTERVAL=0, LAST_SEEN_FLUSH_INTERVAL=0)
+        try:
+            # what the queue of this process waits to write
+            response = client.get('/users/admin/profile/')
+            last_seen.flush()
+        finally:
+            app.config['LAST_SEEN_INTERVAL'], app.config['LAST_SEEN_FLUSH_INTERVAL'] = intervals
+            user_cache.clear()
+        stats = json.loads(response.data.decode('utf-8'))['search']
+        self.assertEqual(stats['pending'], 1)
+        self.assertTrue(stats['oldest_pending_seconds'] > 0)
+        self.assertEqual(stats['failures'], 0)
+
+    def test_reindex(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        for i in range(5):
+            db.session.add(Post(body='cats %d' % i, author=user, timestamp=datetime.utcnow()))
+        db.session.commit()
+        self.backend.queue.flush()
+        db.session.execute(Post.__table__.delete().where(Post.id > 3))
+        db.session.commit()
+
+        self.assertEqual(self.backend.reindex(), 3)
+        self.assertEqual(sorted(self.backend.search('cats', 10)), [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
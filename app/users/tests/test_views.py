@@ -0,0 +1,276 @@
+import json
+import os
+import unittest
+from datetime import datetime, timedelta
+
+from flask import template_rendered
+from sqlalchemy import create_engine, event
+
+from config import _basedir
+from app import create_app, db, fragment_cache, i18n, limiter, mail_queue, profiler
+from app.users.tests import app, is_savepoint, TransactionTestCase
+from babel import support
+from app.users import views
+from app.users import constants as USER
+from app.users.models import User, Post
+from app.users.tracking import last_seen, user_cache
+
+
+class ViewTestCase(TransactionTestCase):
+    def setUp(self):
+        TransactionTestCase.setUp(self)
+        self.app = app.test_client()
+
+    def tearDown(self):
+        last_seen.flush()
+        user_cache.clear()
+        fragment_cache.clear()
+        profiler.reset()
+        limiter.reset()
+        TransactionTestCase.tearDown(self)
+
+    def login(self, user):
+        with self.app.session_transaction() as session:
+            session['user_id'] = user.id
+
+    def count_statements(self, path, statements=None):
+        """Request ``path``, return the number of statements executed,
+        not counting the savepoints; ``statements`` collects them all."""
+        statements = [] if statements is None else statements
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        # requests share the session of the test's app context: start them
+        # with an empty one, like in production
+        db.session.remove()
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = self.app.get(path)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(response.status_code, 200)
+        return len([statement for statement in statements if not is_savepoint(statement)])
+
+    def test_home_statement_count(self):
+        # every post has a different author, so lazy loading authors would
+        # cost one query per post
+        reader = User(name='reader', email='reader@sugarlady.com')
+        db.session.add(reader)
+        utcnow = datetime.utcnow()
+        for i in range(6):
+            author = User(name='author%d' % i, email='author%d@sugarlady.com' % i)
+            db.session.add(author)
+            db.session.add(Post(body='post %d' % i, author=author,
+                                timestamp=utcnow + timedelta(seconds=i)))
+        db.session.commit()
+        for author in User.query.filter(User.id != reader.id):
+            reader.follow(author)
+        db.session.commit()
+        self.login(reader)
+        # the first request loads the signed in user into the cache
+        self.count_statements('/users/reader/')
+
+        per_page = views.POSTS_PER_PAGE
+        try:
+            counts = []
+            for views.POSTS_PER_PAGE in (2, 6):
+                counts.append(self.count_statements('/users/reader/'))
+                counts.append(self.count_statements('/users/reader/1/'))
+        finally:
+            views.POSTS_PER_PAGE = per_page
+        self.assertEqual(counts[0], counts[2])
+        self.assertEqual(counts[1], counts[3])
+
+    def test_before_request_does_not_write(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        db.session.commit()
+        self.login(user)
+
+        statements = []
+        first = self.count_statements('/users/mark/', statements)
+        second = self.count_statements('/users/mark/', statements) - first
+        writes = [s for s in statements
+                  if not s.lstrip().upper().startswith('SELECT') and not is_savepoint(s)]
+        self.assertEqual(writes, [])
+        # the second request found the signed in user in the cache
+        self.assertEqual(first - second, 1)
+
+        # both page views were coalesced in a single pending update
+        self.assertEqual(last_seen.flush(), 1)
+        db.session.expire_all()
+        self.assertEqual(User.query.get(user.id).last_seen, last_seen.last_seen(user.id))
+
+    def test_post_fragments_are_cached(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(user.follow(user))
+        db.session.add(Post(body='post from mark', author=user, timestamp=datetime.utcnow()))
+        db.session.commit()
+        self.login(user)
+
+        rendered = []
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, app)
+        try:
+            self.assertIn(b'post from mark', self.app.get('/users/mark/').data)
+            self.assertIn(b'post from mark', self.app.get('/users/mark/').data)
+            self.assertEqual(rendered.count('users/post.html'), 1)
+
+            # editing the author invalidates the fragment
+            response = self.app.post('/users/edit/', data={'name': 'marcus', 'about_me': 'hi'})
+            self.assertEqual(response.status_code, 302)
+            self.assertIn(b'>marcus</a>', self.app.get('/users/marcus/').data)
+            self.assertEqual(rendered.count('users/post.html'), 2)
+        finally:
+            template_rendered.disconnect(record, app)
+
+    def test_server_side_times(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        db.session.commit()
+        db.session.add(user.follow(user))
+        db.session.add(Post(body='post from mark', author=user,
+                            timestamp=datetime.utcnow() - timedelta(minutes=5, seconds=10)))
+        db.session.commit()
+        self.login(user)
+
+        html = self.app.get('/users/mark/').data.decode('utf-8')
+        self.assertIn(u'data-format="fromNow">5 minutes ago</time>', html)
+        self.assertNotIn(u'document.write', html)
+        self.assertEqual(html.count(u'moment-refresh.js'), 1)
+        html = self.app.get('/users/mark/', headers={'Accept-Language': 'es'}).data.decode('utf-8')
+        self.assertIn(u'>hace 5 minutos</time>', html)
+
+    def test_conditional_get(self):
+        mark = User(name='mark', email='mark@sugarlady.com')
+        anna = User(name='anna', email='anna@sugarlady.com')
+        db.session.add_all([mark, anna])
+        db.session.commit()
+        db.session.add(mark.follow(mark))
+        db.session.add(Post(body='I like cats', author=mark, timestamp=datetime.utcnow()))
+        db.session.commit()
+        self.login(mark)
+
+        # the first view shows when mark was last seen
+        self.app.get('/users/mark/')
+        response = self.app.get('/users/mark/')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        self.assertEqual(response.headers['Vary'], 'Accept-Language, Cookie')
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            response = self.app.get('/users/mark/', headers={'If-None-Match': etag})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        # answered before loading the posts
+        self.assertFalse([statement for statement in statements if 'users_post.body' in statement])
+        # other languages and viewers get other pages
+        self.assertEqual(self.app.get('/users/mark/', headers={
+            'If-None-Match': etag, 'Accept-Language': 'es'}).status_code, 200)
+        self.assertEqual(self.app.get('/users/anna/', headers={'If-None-Match': etag}).status_code, 200)
+
+        # so do new posts and follows
+        db.session.add(Post(body='I like dogs', author=mark,
+                            timestamp=datetime.utcnow() + timedelta(seconds=1)))
+        db.session.commit()
+        response = self.app.get('/users/mark/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        etag = self.app.get('/users/anna/').headers['ETag']
+        self.app.get('/users/follow/anna')
+        # with a message to show
+        response = self.app.get('/users/anna/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+        self.assertNotEqual(self.app.get('/users/anna/').headers['ETag'], etag)
+
+        etag = self.app.get('/users/search_results/cats').headers['ETag']
+        del statements[:]
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.assertEqual(self.app.get('/users/search_results/cats', headers={
+                'If-None-Match': etag}).status_code, 304)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # the cached ids spare the full text query too
+        self.assertFalse([statement for statement in statements
+                          if 'users_post.body' in statement or 'MATCH' in statement])
+        self.assertEqual(self.app.get('/users/search_results/dogs', headers={
+            'If-None-Match': etag}).status_code, 200)
+
+    def test_profile_stats(self):
+        user = User(name='mark', email='mark@sugarlady.com')
+        db.session.add(user)
+        db.session.commit()
+        self.login(user)
+        self.assertEqual(self.app.get('/users/admin/profile/').status_code, 403)
+
+        User.query.filter_by(id=user.id).update({'role': USER.ADMIN})
+        db.session.commit()
+        user_cache.clear()
+        statements = []
+        self.count_statements('/users/mark/', statements)
+        self.count_statements('/users/mark/')
+        stats = json.loads(self.app.get('/users/admin/profile/').data.decode('utf-8'))
+        self.assertIn('cached_queries', stats['search'])
+        home = stats['endpoints']['users.home']
+        self.assertEqual(home['requests'], 2)
+        self.assertEqual(home['max_queries'], len(statements))
+        self.assertTrue(home['time'] >= home['sql_time'] + home['template_time'] > 0)
+
+        self.app.delete('/users/admin/profile/')
+        stats = json.loads(self.app.get('/users/admin/profile/').data.decode('utf-8'))
+        self.assertNotIn('users.home', stats['endpoints'])
+
+    def test_profiler_ignores_other_engines(self):
+        other = create_engine('sqlite://')
+        with app.test_request_context('/users/login/'):
+            profiler._start()
+            other.execute('SELECT 1')
+            self.assertEqual(profiler._local.current['queries'], 0)
+            db.engine.execute('SELECT 1')
+            self.assertEqual(profiler._local.current['queries'], 1)
+            profiler._finish()
+
+    def test_translated_form_labels(self):
+        loads = []
+        load = support.Translations.load
+        i18n.warm()
+        support.Translations.load = staticmethod(
+            lambda *args, **kwargs: loads.append(args) or load(*args, **kwargs))
+        try:
+            chinese = self.app.get('/users/register/', headers={'Accept-Language': 'zh-CN,zh;q=0.8'})
+            english = self.app.get('/users/register/', headers={'Accept-Language': 'en-US'})
+        finally:
+            support.Translations.load = load
+        # labels are translated per request, not once at import time
+        self.assertIn(u'\u91cd\u590d\u5bc6\u7801</label>', chinese.data.decode('utf-8'))
+        self.assertIn(b'Repeat Password</label>', english.data)
+        # with catalogs loaded at startup
+        self.assertEqual(loads, [])
+
+
+class FactoryTestCase(unittest.TestCase):
+    def test_apps_keep_their_own_state(self):
+        other = create_app()
+        with app.app_context():
+            ours = (fragment_cache.backend, limiter.storage, mail_queue.get_queue(),
+                    user_cache._get_current_object())
+        with other.app_context():
+            theirs = (fragment_cache.backend, limiter.storage, mail_queue.get_queue(),
+                      user_cache._get_current_object())
+        for mine, its in zip(ours, theirs):
+            self.assertIsNot(mine, its)
+        self.assertIs(mail_queue.get_queue(app).app, app)
+
+
+if __name__ == '__main__':
+    unittest.main()
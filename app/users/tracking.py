@@ -0,0 +1,169 @@
+import atexit
+import os
+import time
+from datetime import datetime
+from threading import Lock, Thread
+from weakref import WeakSet
+
+from flask import current_app
+from sqlalchemy import bindparam, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from werkzeug.local import LocalProxy
+
+from app import db
+from app.cache import LRUCache
+from app.users.models import User
+
+
+class LastSeenTracker(object):
+    """Coalesces ``last_seen`` updates in memory.
+
+    A user is touched at most once every LAST_SEEN_INTERVAL seconds and the
+    pending timestamps are written in one bulk UPDATE, every
+    LAST_SEEN_FLUSH_INTERVAL seconds by a background thread (or by calling
+    :meth:`flush` when the interval is 0), so page views issue no writes.
+    Every application has its own timestamps, used through the current one,
+    and each process its own flusher, started by its first touch.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        timestamps = _AppTimestamps(app)
+        app.extensions['last_seen'] = timestamps
+        _timestamps.add(timestamps)
+
+    def touch(self, user_id, when=None):
+        return current_app.extensions['last_seen'].touch(user_id, when)
+
+    def last_seen(self, user_id):
+        """The most recent touch of ``user_id`` known to this process."""
+        return current_app.extensions['last_seen'].last_seen(user_id)
+
+    def flush(self):
+        """Write the pending timestamps, return the number of users updated."""
+        return current_app.extensions['last_seen'].flush()
+
+
+# the timestamps of every application, written when the interpreter exits
+_timestamps = WeakSet()
+
+
+@atexit.register
+def _flush_timestamps():
+    for timestamps in list(_timestamps):
+        timestamps.flush_in_context()
+
+
+class _AppTimestamps(object):
+    """The timestamps and the flusher of one application."""
+
+    def __init__(self, app):
+        self.app = app
+        self._reset()
+
+    def _reset(self):
+        # a forked child leaves the timestamps of its parent to the parent
+        self._pid = os.getpid()
+        self._lock = Lock()
+        self._touched = {}
+        self._pending = {}
+        self._flusher = None
+
+    def touch(self, user_id, when=None):
+        when = when or datetime.utcnow()
+        if self._pid != os.getpid():
+            self._reset()
+        with self._lock:
+            last = self._touched.get(user_id)
+            if last is not None and (when - last).total_seconds() < self.app.config['LAST_SEEN_INTERVAL']:
+                return False
+            self._touched[user_id] = when
+            self._pending[user_id] = when
+        self._start_flusher()
+        return True
+
+    def last_seen(self, user_id):
+        return self._touched.get(user_id)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # forget the users whose throttling window is over
+            horizon = datetime.utcnow()
+            for user_id, when in list(self._touched.items()):
+                if (horizon - when).total_seconds() >= self.app.config['LAST_SEEN_INTERVAL']:
+                    del self._touched[user_id]
+        if not pending:
+            return 0
+        users = User.__table__
+        db.session.execute(
+            users.update().where(users.c.id == bindparam('_id')).values(
+                last_seen=bindparam('_last_seen')),
+            [{'_id': user_id, '_last_seen': when} for user_id, when in pending.items()])
+        db.session.commit()
+        return len(pending)
+
+    def _start_flusher(self):
+        interval = self.app.config['LAST_SEEN_FLUSH_INTERVAL']
+        if not interval or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = Thread(target=self._run, args=(interval,))
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def _run(self, interval):
+        while True:
+            time.sleep(interval)
+            self.flush_in_context()
+
+    def flush_in_context(self):
+        if self._pid != os.getpid():
+            return
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Cannot write last_seen timestamps')
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+
+last_seen = LastSeenTracker()
+
+# column values of recently loaded users, keyed by id, in the cache of the
+# current application
+user_cache = LocalProxy(lambda: current_app.extensions['user_cache'])
+
+
+def init_tracking(app):
+    last_seen.init_app(app)
+    app.extensions['user_cache'] = LRUCache(maxsize=app.config['USER_CACHE_SIZE'],
+                                            ttl=app.config['USER_CACHE_TTL'])
+
+
+def load_user(user_id):
+    """Return the user ``user_id`` attached to the current session.
+
+    Users are rebuilt from :data:`user_cache` without a query when possible;
+    views changing a user must call ``user_cache.delete(user.id)``.
+    """
+    state = user_cache.get(user_id)
+    if state is None:
+        user = User.query.get(user_id)
+        if user is not None:
+            user_cache.set(user_id, dict((attr.key, getattr(user, attr.key))
+                                         for attr in inspect(User).column_attrs))
+        return user
+    user = User()
+    for key, value in state.items():
+        setattr(user, key, value)
+    user.last_seen = last_seen.last_seen(user_id) or user.last_seen
+    # mark the rebuilt instance as loaded from the database, then attach it
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
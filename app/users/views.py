@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime
-from flask import Blueprint, request, render_template, flash, g, session, redirect, url_for
+from flask import Blueprint, request, render_template, flash, g, session, redirect, url_for, abort, jsonify
 from werkzeug import check_password_hash, generate_password_hash
 from flask.ext.babel import gettext
 
-from app import db, babel
+from app import db, babel, fragment_cache, i18n, limiter, profiler
 from app.emails import follower_notification
+from app.httpcache import page_etag, conditional
+from app.search import get_backend, search_ids
 from app.users.forms import RegisterForm, LoginForm, EditForm, PostForm, SearchForm
 from app.users.models import User, Post
-from app.users.decorators import requires_login
-from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS, LANGUAGES
+from app.users.tracking import last_seen, load_user, user_cache
+from app.users.decorators import requires_login, requires_admin
+from config import POSTS_PER_PAGE, MAX_SEARCH_RESULTS
 
 
 mod = Blueprint('users', __name__, url_prefix='/users')
@@ -18,26 +21,45 @@ mod = Blueprint('users', __name__, url_prefix='/users')
 
 @babel.localeselector
 def get_locale():
-    return request.accept_languages.best_match(LANGUAGES.keys())
+    return i18n.best_match(request.headers.get('Accept-Language', ''))
 
 
 @mod.route('/<name>/', methods=['GET', 'POST'])
+@mod.route('/<name>/posts/<cursor>/', methods=['GET', 'POST'])
 @mod.route('/<name>/<int:page>/', methods=['GET', 'POST'])
 @requires_login
-def home(name, page=1):
+@limiter.limit('post', methods=('POST',))
+def home(name, page=None, cursor=None):
     form = PostForm()
     if form.validate_on_submit():
         post = Post(body=form.post.data, timestamp=datetime.utcnow(), author=g.user)
-        db.session.add(post)
+        post.publish()
         db.session.commit()
+        user_cache.delete(g.user.id)
         flash(gettext('Your post is live now!'))
         redirect(url_for('users.home', name=name, page=page))
     user = User.query.filter_by(name=name).first()
-    posts = user.followed_posts().paginate(page, POSTS_PER_PAGE, False) if user else []
-    if user:
-        return render_template('users/profile.html', user=user, form=form, posts=posts)
-    else:
+    if not user:
         return render_template('404.html')
+    # the page is first listed without loading its posts, which a 304 skips
+    if page is not None:
+        # page numbers are kept for old links, new ones use cursors
+        posts = user.followed_post_versions().paginate(page, POSTS_PER_PAGE, False)
+    else:
+        try:
+            posts = user.followed_versions_page(cursor, POSTS_PER_PAGE)
+        except ValueError:
+            abort(404)
+    # everything the page shows, but the forms
+    tag = page_etag(user.id, user.name, user.email, user.about_me, user.last_seen,
+                    user.followers_count, user == g.user or g.user.is_following(user),
+                    page, cursor, posts.has_prev, posts.has_next,
+                    [fragment_cache.post_key(*version) for version in posts.items])
+
+    def render():
+        posts.items = Post.load([version.id for version in posts.items])
+        return render_template('users/profile.html', user=user, form=form, posts=posts)
+    return conditional(tag, render)
 
 
 @mod.before_request
@@ -47,11 +69,9 @@ def before_request():
     """
     g.user = None
     if 'user_id' in session:
-        g.user = User.query.get(session['user_id'])
+        g.user = load_user(session['user_id'])
         if g.user:
-            g.user.last_seen = datetime.utcnow()
-            db.session.add(g.user)
-            db.session.commit()
+            last_seen.touch(g.user.id)
             g.search_form = SearchForm()
     g.locale = get_locale()
 
@@ -85,18 +105,12 @@ def register():
     """
     form = RegisterForm()
     if form.validate_on_submit():
-        # get the unique name
-        form.name.data = User.make_valid_name(form.name.data)
-        form.name.data = User.make_unique_name(form.name.data)
-        # create an user instance not yet stored in the database
-        user = User(name=form.name.data, email=form.email.data, \
-            password=generate_password_hash(form.password.data))
-        # Insert the record in our database and commit it
-        db.session.add(user)
-        db.session.commit()
+        # insert the user under a unique name and commit it
+        user = User.create(User.make_valid_name(form.name.data), form.email.data,
+            generate_password_hash(form.password.data))
         # make the user follow himself/herself
         db.session.add(user.follow(user))
-        db.session.commit(user)
+        db.session.commit()
        
         # Log the user in, as he now has an id
         session['user_id'] = user.id
@@ -124,9 +138,13 @@ def search():
 
 @mod.route('/search_results/<query>')
 @requires_login
+@limiter.limit('search')
 def search_results(query):
-    results = Post.query.whoosh_search(query, MAX_SEARCH_RESULTS).all()
-    return render_template('search_results.html', query=query, results=results)
+    # from the cache of the search backend when the query ran before
+    ids = search_ids(query, MAX_SEARCH_RESULTS)
+    tag = page_etag(query, [fragment_cache.post_key(*version) for version in Post.versions(ids)])
+    return conditional(tag, lambda: render_template(
+        'search_results.html', query=query, results=Post.load(ids)))
 
 
 @mod.route('/edit/', methods=['GET', 'POST'])
@@ -138,6 +156,7 @@ def edit():
         g.user.about_me = form.about_me.data
         db.session.add(g.user)
         db.session.commit()
+        user_cache.delete(g.user.id)
         flash(gettext('Your changes have been saved.'))
         return redirect(url_for('users.home', name=g.user.name))
     else:
@@ -148,6 +167,7 @@ def edit():
 
 @mod.route('/follow/<name>')
 @requires_login
+@limiter.limit('follow')
 def follow(name):
     user = User.query.filter_by(name=name).first()
     if not user:
@@ -161,14 +181,18 @@ def follow(name):
         flash(gettext('Cannot follow %(name)s.', name=name))
         return redirect(url_for('users.home', name=user.name))
     db.session.add(u)
+    # a mail is only sent once the follow is committed
+    follower_notification(user, g.user)
     db.session.commit()
+    user_cache.delete(user.id)
+    user_cache.delete(g.user.id)
     flash(gettext('You are now following %(name)s.', name=name))
-    follower_notification(user, g.user)
     return redirect(url_for('users.home', name=user.name))
 
 
 @mod.route('/unfollow/<name>')
 @requires_login
+@limiter.limit('follow')
 def unfollow(name):
     user = User.query.filter_by(name=name).first()
     if not user:
@@ -183,5 +207,17 @@ def unfollow(name):
         return redirect(url_for('users.home', name=user.name))
     db.session.add(u)
     db.session.commit()
+    user_cache.delete(user.id)
+    user_cache.delete(g.user.id)
     flash(gettext('You have stopped following %(name)s.', name=name))
     return redirect(url_for('users.home', name=user.name))
+
+
+@mod.route('/admin/profile/', methods=['GET', 'DELETE'])
+@requires_admin
+def profile_stats():
+    """Per endpoint timings and query counts, DELETE starts them over, and
+    the metrics of the search indexing of this process."""
+    if request.method == 'DELETE':
+        profiler.reset()
+    return jsonify(endpoints=profiler.stats(), search=get_backend().stats())
@@ -0,0 +1,10 @@
+"""Performance benchmarks, run them from the repository root, e.g.
+
+    python -m bench.unique_name
+    python -m bench.i18n
+    python -m bench.suite --output before.json
+    python -m bench.compare before.json after.json
+    python -m bench.load http://127.0.0.1:8000  # against python serve.py
+
+bench.data generates the synthetic datasets the benchmarks run on.
+"""
@@ -0,0 +1,38 @@
+"""Compare two runs of bench.suite.
+
+usage: python -m bench.compare <before.json> <after.json>
+"""
+
+import json
+import sys
+
+MEASURES = ('seconds', 'min', 'statements')
+
+
+def key(result):
+    """What identifies a result across runs: everything but its measures."""
+    return tuple(sorted((name, value) for name, value in result.items()
+                        if name not in MEASURES))
+
+
+def compare(before, after):
+    """Yield ``(key, before result, after result)`` for the results of both runs."""
+    previous = dict((key(result), result) for result in before['results'])
+    for result in after['results']:
+        if key(result) in previous:
+            yield key(result), previous[key(result)], result
+
+
+def main(argv):
+    before, after = [json.load(open(path)) for path in argv]
+    for (name, old, new) in compare(before, after):
+        label = ' '.join('%s=%s' % item if item[0] != 'benchmark' else item[1]
+                         for item in name)
+        print('%-50s %9.2fms %9.2fms %6.2fx %5d -> %d statements' % (
+            label, old['seconds'] * 1000, new['seconds'] * 1000,
+            old['seconds'] / new['seconds'] if new['seconds'] else float('inf'),
+            old['statements'], new['statements']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,103 @@
+"""Reproducible synthetic datasets.
+
+Users are ranked by popularity: user ``i`` is followed, and posts, in
+proportion to ``1 / i ** ALPHA``, which gives the power-law follower counts
+of real social graphs (a few celebrities, a long tail). The same arguments
+always produce the same rows.
+
+usage: python -m bench.data <database uri> [users] [posts]
+"""
+
+import bisect
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from werkzeug import generate_password_hash
+
+from flask import current_app
+
+from app import create_app, db
+from app.users.models import User, Post, followers
+
+ALPHA = 1.2
+PASSWORD = 'password'
+# rows per INSERT
+CHUNK_SIZE = 5000
+
+WORDS = ('cat dog bird python flask coffee music travel photo summer winter '
+         'city beach mountain book movie game code bug release weekend food '
+         'friend work party news sport football garden rain sun night').split()
+
+
+class PowerLaw(object):
+    """Draws integers in ``range(n)``, ``i`` with a weight of ``1 / (i + 1) ** alpha``."""
+
+    def __init__(self, n, alpha, rnd):
+        self.rnd = rnd
+        self.cumulative = []
+        total = 0.0
+        for i in range(n):
+            total += 1.0 / (i + 1) ** alpha
+            self.cumulative.append(total)
+
+    def draw(self):
+        return bisect.bisect(self.cumulative, self.rnd.random() * self.cumulative[-1])
+
+
+def insert(table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def generate(users=1000, posts=10000, follows=20, seed=0):
+    """Fill the (empty) database with ``users`` users, following ``follows``
+    others on average, and ``posts`` posts. Return the row counts."""
+    rnd = random.Random(seed)
+    popularity = PowerLaw(users, ALPHA, rnd)
+    vocabulary = PowerLaw(len(WORDS), 1.0, rnd)
+    # hashing is slow on purpose, every user shares the same password
+    password = generate_password_hash(PASSWORD)
+    start = datetime(2015, 1, 1)
+
+    insert(User.__table__, [{
+        'id': i + 1, 'name': 'user%d' % (i + 1), 'email': 'user%d@example.com' % (i + 1),
+        'password': password, 'about_me': 'Synthetic user %d' % (i + 1),
+        'last_seen': start} for i in range(users)])
+
+    edges = set((i, i) for i in range(1, users + 1))
+    for follower in range(1, users + 1):
+        # out degrees are spread around the mean, in-degrees follow popularity
+        for j in range(int(rnd.expovariate(1.0 / follows))):
+            edges.add((follower, popularity.draw() + 1))
+    insert(followers, [{'follower_id': follower, 'followed_id': followed}
+                       for follower, followed in sorted(edges)])
+
+    insert(Post.__table__, [{
+        'id': i + 1, 'user_id': popularity.draw() + 1,
+        'timestamp': start + timedelta(seconds=i * 60 + rnd.randint(0, 59)),
+        'body': ' '.join(WORDS[vocabulary.draw()] for j in range(rnd.randint(3, 12)))}
+        for i in range(posts)])
+    db.session.commit()
+
+    User.reconcile_counters()
+    if current_app.config.get('TIMELINE_ENABLED'):
+        User.rebuild_timelines()
+    return {'users': users, 'follows': len(edges), 'posts': posts}
+
+
+def main(argv):
+    app = create_app()
+    app.config['SQLALCHEMY_DATABASE_URI'] = argv[0]
+    with app.app_context():
+        db.create_all()
+        start = time.time()
+        counts = generate(*[int(arg) for arg in argv[1:3]])
+    print('Generated %s in %.1fs' % (', '.join(
+        '%d %s' % (count, name) for name, count in sorted(counts.items())),
+        time.time() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
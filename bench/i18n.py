@@ -0,0 +1,63 @@
+"""Per request cost of choosing the locale and translating, with
+Flask-Babel's own lookups and with app.i18n's caches.
+
+usage: python -m bench.i18n [repeat]
+"""
+
+import json
+import sys
+import time
+
+from babel import Locale
+from flask import request
+from flask.ext.babel import gettext
+
+from app import create_app, babel, i18n
+from app.users.forms import LoginForm
+
+app = create_app()
+
+HEADERS = {
+    'en': 'en-US,en;q=0.8',
+    'es': 'es-ES,es;q=0.9,en;q=0.5',
+    'zh': 'zh-CN,zh;q=0.8,en-US;q=0.5,en;q=0.3',
+}
+STRINGS = ['Home', 'Your profile', 'Logout', 'Search', 'Wrong email or password']
+
+
+def uncached():
+    # what every request did before: parse the header and the locale, and
+    # let Flask-Babel and Flask-WTF load the catalogs
+    name = request.accept_languages.best_match(app.config['LANGUAGES'].keys())
+    request.babel_locale = Locale.parse(name) if name else babel.default_locale
+
+
+def cached():
+    i18n._before_request()
+
+
+def measure(prepare, header, repeat):
+    start = time.time()
+    for i in range(repeat):
+        with app.test_request_context(headers={'Accept-Language': header}):
+            prepare()
+            for string in STRINGS:
+                gettext(string)
+            # the labels and the WTForms messages
+            form = LoginForm(csrf_enabled=False)
+            form.validate()
+            [field.label() for field in form]
+    return (time.time() - start) / repeat
+
+
+def main(argv):
+    repeat = int(argv[0]) if argv else 1000
+    for language, header in sorted(HEADERS.items()):
+        for prepare in (uncached, cached):
+            print(json.dumps({'benchmark': 'i18n', 'lookup': prepare.__name__,
+                              'language': language,
+                              'seconds': measure(prepare, header, repeat)}))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+"""Throughput and latency of a running server (see serve.py): ``concurrency``
+clients request the paths in turn, back to back, for ``duration`` seconds.
+
+usage: python -m bench.load <base url> [--concurrency N] [--duration SECONDS]
+                            [--path PATH ...] [--email EMAIL --password PASSWORD]
+
+With an email and a password every client signs in first, and requests
+the user's home page unless paths are given. The results are printed as a
+JSON document.
+"""
+
+import argparse
+import json
+import re
+import threading
+import time
+
+try:
+    import httplib  # python 2
+    from cookielib import CookieJar
+    from urllib import urlencode
+    from urllib2 import build_opener, HTTPCookieProcessor, HTTPError
+except ImportError:
+    import http.client as httplib  # python 3
+    from http.cookiejar import CookieJar
+    from urllib.parse import urlencode
+    from urllib.request import build_opener, HTTPCookieProcessor
+    from urllib.error import HTTPError
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def sign_in(opener, base_url, email, password):
+    """Sign ``opener`` in, return the path of the user's home page."""
+    page = opener.open(base_url + '/users/login/').read().decode('utf-8')
+    token = CSRF_TOKEN.search(page)
+    form = {'email': email, 'password': password}
+    if token:
+        form['csrf_token'] = token.group(1)
+    response = opener.open(base_url + '/users/login/', urlencode(form).encode('utf-8'))
+    response.read()
+    if response.geturl().rstrip('/').endswith('/users/login'):
+        raise ValueError('Cannot sign in as %s' % email)
+    return response.geturl()[len(base_url):]
+
+
+class Client(threading.Thread):
+    def __init__(self, base_url, paths, deadline, credentials=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.base_url = base_url
+        self.paths = paths
+        self.deadline = deadline
+        self.credentials = credentials
+        self.requested = paths
+        self.latencies = []
+        self.statuses = {}
+        self.error = None
+
+    def run(self):
+        opener = build_opener(HTTPCookieProcessor(CookieJar()))
+        try:
+            paths = self.paths
+            if self.credentials:
+                home = sign_in(opener, self.base_url, *self.credentials)
+                paths = self.requested = paths or [home]
+            i = 0
+            while time.time() < self.deadline:
+                start = time.time()
+                try:
+                    response = opener.open(self.base_url + paths[i % len(paths)])
+                    response.read()
+                    status = response.getcode()
+                except HTTPError as e:
+                    status = e.code
+                except (IOError, httplib.HTTPException) as e:
+                    # the connection was refused, reset or closed early
+                    status = type(e).__name__
+                self.latencies.append(time.time() - start)
+                self.statuses[status] = self.statuses.get(status, 0) + 1
+                i += 1
+        except Exception as e:
+            self.error = repr(e)
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0
+
+
+def run(base_url, concurrency=16, duration=30, paths=None, credentials=None):
+    base_url = base_url.rstrip('/')
+    paths = paths or ([] if credentials else ['/users/login/'])
+    start = time.time()
+    clients = [Client(base_url, paths, start + duration, credentials)
+               for i in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    statuses = {}
+    for client in clients:
+        for status, count in client.statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    return {
+        'url': base_url,
+        'paths': clients[0].requested,
+        'concurrency': concurrency,
+        'seconds': elapsed,
+        'requests': len(latencies),
+        'requests_per_second': len(latencies) / elapsed,
+        'statuses': statuses,
+        'errors': [client.error for client in clients if client.error],
+        'latency': {
+            'median': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test a running microblog')
+    parser.add_argument('url', help='base url, e.g. http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--path', action='append', dest='paths', metavar='PATH')
+    parser.add_argument('--email')
+    parser.add_argument('--password')
+    args = parser.parse_args()
+    credentials = (args.email, args.password) if args.email else None
+    print(json.dumps(run(args.url, args.concurrency, args.duration, args.paths, credentials),
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Benchmarks of the hot paths on a synthetic dataset (see bench.data).
+
+Every result is the median and minimum wall time of ``repeat`` calls, with
+the number of SQL statements per call. The run is written as a JSON
+document that bench.compare can diff against another run.
+
+usage: python -m bench.suite [--users N] [--posts N] [--repeat N] [--output FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+from sqlalchemy import event, inspect
+
+from app import create_app, db
+from app.search import get_backend, search_posts
+from app.users.models import User, followers
+from app.users.tracking import user_cache
+from bench import data
+
+app = create_app()
+
+BENCHMARKS = []
+
+
+def benchmark(function):
+    BENCHMARKS.append(function)
+    return function
+
+
+def measure(function, repeat, setup=None):
+    """Time ``repeat`` calls of ``function``, calling ``setup`` untimed
+    before each of them."""
+    times = []
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        event.listen(db.engine, 'before_cursor_execute', count)
+        start = time.time()
+        try:
+            function()
+        finally:
+            times.append(time.time() - start)
+            event.remove(db.engine, 'before_cursor_execute', count)
+    times.sort()
+    return {'seconds': times[len(times) // 2], 'min': times[0],
+            'statements': len(statements) // repeat}
+
+
+def fresh_session():
+    """Start the next call without anything loaded, like a new request."""
+    db.session.remove()
+    user_cache.clear()
+
+
+class Dataset(object):
+    """Users picked once per run: the most followed one and a reader
+    following a typical number of users."""
+
+    def __init__(self):
+        self.celebrity = 1
+        counts = sorted(db.session.query(followers.c.follower_id, db.func.count()).group_by(
+            followers.c.follower_id), key=lambda row: (row[1], row[0]))
+        self.reader = counts[len(counts) // 2][0]
+        self.reader_name = User.query.get(self.reader).name
+        db.session.remove()
+
+
+@benchmark
+def followed_posts(dataset, repeat):
+    per_page = app.config['POSTS_PER_PAGE']
+    for depth in (1, 10, 100):
+        def offset():
+            User.query.get(dataset.reader).followed_posts().paginate(depth, per_page, False).items
+        yield dict(measure(offset, repeat, fresh_session), benchmark='followed_posts',
+                   pagination='offset', depth=depth)
+
+        cursor = None
+        reader = User.query.get(dataset.reader)
+        for page in range(depth - 1):
+            cursor = reader.followed_posts_page(cursor, per_page).next_cursor
+            if cursor is None:
+                break
+        if depth > 1 and cursor is None:
+            continue
+
+        def keyset():
+            User.query.get(dataset.reader).followed_posts_page(cursor, per_page).items
+        yield dict(measure(keyset, repeat, fresh_session), benchmark='followed_posts',
+                   pagination='keyset', depth=depth)
+
+
+@benchmark
+def is_following(dataset, repeat):
+    def one():
+        User.query.get(dataset.reader).is_following(User.query.get(dataset.celebrity))
+    yield dict(measure(one, repeat, fresh_session), benchmark='is_following', users=1)
+
+    ids = list(range(1, 101))
+    def many():
+        User.query.get(dataset.reader).relationship_map(ids)
+    yield dict(measure(many, repeat, fresh_session), benchmark='is_following', users=len(ids))
+
+
+@benchmark
+def make_unique_name(dataset, repeat):
+    # 'user1' collides with user10..user19, user100..., all scanned
+    yield dict(measure(lambda: User.make_unique_name('user1'), repeat, fresh_session),
+               benchmark='make_unique_name', name='user1')
+
+
+@benchmark
+def registration(dataset, repeat):
+    client = app.test_client()
+    emails = ('new%d@example.com' % i for i in range(repeat))
+
+    def register():
+        response = client.post('/users/register/', data={
+            'name': 'user1', 'email': next(emails), 'password': data.PASSWORD,
+            'confirm': data.PASSWORD, 'accept_tos': 'y'})
+        assert response.status_code == 302, response.status_code
+        client.get('/users/logout/')
+    yield dict(measure(register, repeat, fresh_session), benchmark='registration')
+
+
+@benchmark
+def search(dataset, repeat):
+    cache = get_backend(app).cache
+    for query in ('cat', 'coffee music', 'night'):
+        def run():
+            search_posts(query, app.config['MAX_SEARCH_RESULTS'])
+
+        def cold():
+            fresh_session()
+            cache.clear()
+        yield dict(measure(run, repeat, cold), benchmark='search', query=query, cache='cold')
+        yield dict(measure(run, repeat, fresh_session), benchmark='search', query=query,
+                   cache='warm')
+
+
+@benchmark
+def home(dataset, repeat):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = dataset.reader
+    for name, profile in (('reader', dataset.reader_name), ('celebrity', 'user1')):
+        def get():
+            response = client.get('/users/%s/' % profile)
+            assert response.status_code == 200, response.status_code
+        yield dict(measure(get, repeat, fresh_session), benchmark='home', profile=name)
+
+
+def run(users, posts, repeat, seed=0, database=None, only=None):
+    directory = None
+    if database is None:
+        directory = tempfile.mkdtemp()
+        database = 'sqlite:///' + os.path.join(directory, 'bench.db')
+    app.config.update(SQLALCHEMY_DATABASE_URI=database, TESTING=True,
+                      WTF_CSRF_ENABLED=False, LAST_SEEN_FLUSH_INTERVAL=0)
+    try:
+        with app.app_context():
+            if inspect(db.engine).get_table_names():
+                raise SystemExit('%s is not empty, refusing to overwrite it' % database)
+            db.create_all()
+            start = time.time()
+            counts = data.generate(users, posts, seed=seed)
+            generation = time.time() - start
+            dataset = Dataset()
+            results = []
+            for function in BENCHMARKS:
+                if only and function.__name__ not in only:
+                    continue
+                results.extend(function(dataset, repeat))
+                fresh_session()
+            db.session.remove()
+            if directory is None:
+                # leave the given database empty, as it was found
+                db.drop_all()
+            db.get_engine(app).dispose()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+    return {
+        'meta': {
+            'dataset': dict(counts, seed=seed, generation_seconds=generation),
+            'repeat': repeat,
+            'database': database.split(':', 1)[0],
+            'timeline_enabled': bool(app.config.get('TIMELINE_ENABLED')),
+            'search_backend': app.config['SEARCH_BACKEND'],
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='microblog benchmarks')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--database', help='SQLAlchemy URI of an empty database '
+                                           '(default: a temporary SQLite file)')
+    parser.add_argument('--output', help='write the results there instead of stdout')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='only run these (%s)' % ', '.join(f.__name__ for f in BENCHMARKS))
+    args = parser.parse_args(argv)
+    report = run(args.users, args.posts, args.repeat, args.seed, args.database, args.benchmarks)
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
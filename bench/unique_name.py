@@ -0,0 +1,59 @@
+"""Cost of User.make_unique_name as the number of taken variants grows.
+
+usage: python -m bench.unique_name [collisions ...]
+"""
+
+import json
+import sys
+import time
+
+from sqlalchemy import event
+
+from app import create_app, db
+from app.users.models import User
+
+app = create_app()
+
+
+def probe_unique_name(name):
+    """The previous implementation, one query per candidate, for comparison."""
+    if User.query.filter_by(name=name).first() is None:
+        return name
+    version = 2
+    while User.query.filter_by(name=name + str(version)).first() is not None:
+        version += 1
+    return name + str(version)
+
+
+def measure(function, collisions, repeat=5):
+    db.drop_all()
+    db.create_all()
+    names = ['john'] + ['john%d' % i for i in range(2, collisions + 1)]
+    db.session.execute(User.__table__.insert(), [
+        {'name': name, 'email': '%s@sugarlady.com' % name} for name in names])
+    db.session.commit()
+
+    statements = []
+    def count(*args):
+        statements.append(1)
+    event.listen(db.engine, 'before_cursor_execute', count)
+    start = time.time()
+    for i in range(repeat):
+        name = function('john')
+    elapsed = (time.time() - start) / repeat
+    event.remove(db.engine, 'before_cursor_execute', count)
+    assert name == 'john%d' % (collisions + 1)
+    return {'benchmark': function.__name__, 'collisions': collisions,
+            'seconds': elapsed, 'statements': len(statements) // repeat}
+
+
+def main(argv):
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    with app.app_context():
+        for collisions in [int(arg) for arg in argv] or [1, 10, 100, 1000, 5000]:
+            for function in (User.make_unique_name, probe_unique_name):
+                print(json.dumps(measure(function, collisions)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import multiprocessing
 import os
 _basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -8,10 +9,46 @@ DEBUG = False
 ADMINS = frozenset(['youremail@yourdomain.com'])
 SECRET_KEY = 'This string will be replaced with a proper key in production.'
 
-SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(_basedir, 'app.db')
+# the DATABASE_URL environment variable overrides the database
+SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+    'sqlite:///' + os.path.join(_basedir, 'app.db')
+# extra arguments of the DB-API connect() call
 DATABASE_CONNECT_OPTIONS = {}
+# read-only copies of the database to send the reads to, from the comma
+# separated DATABASE_REPLICA_URLS; after writing, a user reads from the
+# primary for REPLICA_STICKY_SECONDS, longer than the replication lag
+SQLALCHEMY_REPLICAS = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+REPLICA_STICKY_SECONDS = 10
 
-THREADS_PER_PAGE = 8
+# connections kept open per process, plus up to SQLALCHEMY_MAX_OVERFLOW
+# more under load; a pool size of 0 opens a connection per checkout
+SQLALCHEMY_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+SQLALCHEMY_POOL_TIMEOUT = 30
+SQLALCHEMY_POOL_RECYCLE = int(os.environ.get('DATABASE_POOL_RECYCLE', 3600))
+
+# run on every new SQLite connection, in order: wait for locks instead of
+# failing with "database is locked", and let readers proceed while a
+# writer commits (WAL journal, which only needs syncing at checkpoints)
+SQLITE_PRAGMAS = [
+    ('busy_timeout', 5000),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 64 * 1024 * 1024),
+]
+
+# production server (python serve.py): SERVER_WORKERS processes serving
+# SERVER_THREADS requests at a time each. A worker is restarted after
+# SERVER_MAX_REQUESTS requests (0: never) and killed when a request takes
+# more than SERVER_TIMEOUT seconds; on `kill -HUP` of the master the workers
+# are replaced by new ones running the current code, the old ones finishing
+# their requests within SERVER_GRACEFUL_TIMEOUT seconds
+SERVER_BIND = os.environ.get('BIND', '127.0.0.1:8000')
+SERVER_WORKERS = int(os.environ.get('WEB_CONCURRENCY', 2 * multiprocessing.cpu_count() + 1))
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
+SERVER_TIMEOUT = 30
+SERVER_GRACEFUL_TIMEOUT = 30
+SERVER_MAX_REQUESTS = 0
 
 WTF_CSRF_ENABLED = True
 WTF_CSRF_SECRET_KEY = "somethingimpossibletoguess"
@@ -23,9 +60,65 @@ RECAPTCHA_OPTIONS = {'theme': 'white'}
 
 POSTS_PER_PAGE = 3
 
+# log requests and SQL statements taking longer than this many seconds
+# (None: never); the timings of every endpoint, and the search indexing
+# metrics, are at /users/admin/profile/
+SLOW_REQUEST_TIME = None
+SLOW_QUERY_TIME = None
+
+# cache of rendered posts. FRAGMENT_CACHE_BACKEND may name a werkzeug cache
+# class (e.g. 'werkzeug.contrib.cache.MemcachedCache') to build with
+# FRAGMENT_CACHE_OPTIONS, to share the fragments between processes
+FRAGMENT_CACHE_BACKEND = None
+FRAGMENT_CACHE_OPTIONS = {}
+FRAGMENT_CACHE_SIZE = 10000
+
+# materialized home timelines (fan-out on write). After switching this on
+# for an existing database run `python manage.py rebuild_timelines`.
+TIMELINE_ENABLED = False
+TIMELINE_LENGTH = 800
+TIMELINE_TRIM_EVERY = 50
+
+# last_seen is written at most once per LAST_SEEN_INTERVAL seconds per user,
+# in bulk every LAST_SEEN_FLUSH_INTERVAL seconds (0: only on explicit flush)
+LAST_SEEN_INTERVAL = 60
+LAST_SEEN_FLUSH_INTERVAL = 10
+
+# per-process cache of the signed in users
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60
+
+# requests a client (signed in user, else address) may make: RATELIMITS
+# maps the limits of the views to (requests, seconds), allowing bursts of
+# up to `requests`. Each process counts on its own unless RATELIMIT_STORAGE
+# is 'sqlite', sharing the counts through RATELIMIT_SQLITE_PATH
+RATELIMIT_ENABLED = True
+RATELIMITS = {
+    'post': (10, 60),
+    'follow': (30, 60),
+    'search': (20, 60),
+}
+RATELIMIT_STORAGE = 'memory'
+RATELIMIT_SQLITE_PATH = os.path.join(_basedir, 'ratelimit.db')
+RATELIMIT_MEMORY_KEYS = 100000
+
+# full text search engine: 'sqlite' (FTS5 index in the database) or
+# 'whoosh' (index in WHOOSH_BASE, python 2 only)
+SEARCH_BACKEND = 'sqlite'
 WHOOSH_BASE = os.path.join(_basedir, 'search.db')
 MAX_SEARCH_RESULTS = 50
 
+# the whoosh index is written in the background, in batches of up to
+# SEARCH_INDEX_BATCH_SIZE posts, at most SEARCH_INDEX_MAX_STALENESS seconds
+# after they were committed
+SEARCH_INDEX_BATCH_SIZE = 100
+SEARCH_INDEX_MAX_STALENESS = 5
+
+# ranked results of the last SEARCH_CACHE_SIZE queries, kept until posts
+# matching them are indexed or for SEARCH_CACHE_TTL seconds
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 300
+
 # email server
 MAIL_SERVER = 'smtp.googlemail.com'
 MAIL_PORT = 465
@@ -34,12 +127,34 @@ MAIL_USE_SSL = True
 MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
 MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
 
+# outgoing mail queue, see app/mailqueue.py
+MAIL_WORKERS = 2
+MAIL_QUEUE_SIZE = 1000
+MAIL_QUEUE_TIMEOUT = 5
+MAIL_BATCH_SIZE = 50
+MAIL_RETRIES = 3
+MAIL_RETRY_BACKOFF = 1
+MAIL_SHUTDOWN_TIMEOUT = 30
+
+# 'immediate': one mail per follow, 'digest': follows are recorded and
+# announced by `python manage.py send_digests`, to be run periodically
+FOLLOWER_NOTIFICATIONS = 'immediate'
+FOLLOWER_DIGEST_MAX_LISTED = 20
+# used to build the links of mails sent outside of a request
+BASE_URL = 'http://localhost:5000'
+
 # administrator list
 ADMINS = ['dingweihuaic@gmail.com']
 
+# 'server': write times in <time> elements, refreshed by a single deferred
+# script; 'client': emit a moment.js script for every time
+MOMENTJS_MODE = 'server'
+
 # available languages
 LANGUAGES = {
     'en': 'English',
     'es': 'Español',
     'zh': '简体中文(中国)'
 }
+# Accept-Language header values whose best language is remembered
+ACCEPT_LANGUAGE_CACHE_SIZE = 256
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Maintenance commands.
+
+usage: python manage.py <command>
+"""
+
+import argparse
+import sys
+
+from flask import current_app
+
+from app import create_app, db
+from app.bulk import export, load
+from app.emails import send_follower_digests
+from app.migrations import upgrade
+from app.search import get_backend
+from app.users.models import User
+
+
+def migrate(args):
+    applied = upgrade()
+    print('Applied migrations: %s' % (', '.join(applied) or 'none'))
+
+
+def rebuild_timelines(args):
+    count = User.rebuild_timelines()
+    print('Rebuilt %d timelines.' % count)
+
+
+def reconcile_counters(args):
+    count = User.reconcile_counters()
+    print('Fixed the counters of %d users.' % count)
+
+
+def send_digests(args):
+    # the mails link to profiles, which needs a request to build urls
+    with current_app.test_request_context(base_url=current_app.config['BASE_URL']):
+        count = send_follower_digests()
+    print('Sent %d follower digests.' % count)
+
+
+def reindex(args):
+    search = get_backend()
+    count = search.reindex()
+    print('Indexed %d posts.' % count)
+    for name, value in sorted(search.stats().items()):
+        print('%s: %s' % (name, value))
+
+
+def export_data(args):
+    output = sys.stdout if args.file == '-' else open(args.file, 'w')
+    try:
+        report = export(output, args.tables, args.chunk_size)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    for line in report.lines():
+        sys.stderr.write(line + '\n')
+
+
+def import_data(args):
+    lines = sys.stdin if args.file == '-' else open(args.file)
+    try:
+        report = load(lines, args.chunk_size)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    for line in report.lines():
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='microblog maintenance commands')
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('migrate',
+        help='bring the database schema up to date')
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser('rebuild_timelines',
+        help='backfill the materialized home timelines')
+    command.set_defaults(func=rebuild_timelines)
+
+    command = commands.add_parser('reconcile_counters',
+        help='recompute the follower, following and post counters of every user')
+    command.set_defaults(func=reconcile_counters)
+
+    command = commands.add_parser('send_digests',
+        help='mail every user the followers gained since the last run')
+    command.set_defaults(func=send_digests)
+
+    command = commands.add_parser('reindex',
+        help='rebuild the full text search index of the posts')
+    command.set_defaults(func=reindex)
+
+    command = commands.add_parser('export',
+        help='dump the users, follows and posts as NDJSON')
+    command.add_argument('file', help="where to write, '-' for stdout")
+    command.add_argument('--tables', nargs='+', metavar='TABLE',
+        help='only these tables (users_user, followers, users_post)')
+    command.add_argument('--chunk-size', type=int, default=1000)
+    command.set_defaults(func=export_data)
+
+    command = commands.add_parser('import',
+        help='load the users, follows and posts of an export')
+    command.add_argument('file', help="where to read, '-' for stdin")
+    command.add_argument('--chunk-size', type=int, default=1000)
+    command.set_defaults(func=import_data)
+
+    args = parser.parse_args()
+    with create_app().app_context():
+        db.create_all()
+        args.func(args)
+
+
+if __name__ == '__main__':
+    main()
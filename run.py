@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
 
-from app import app
+from app import create_app
+app = create_app()
 app.run(debug=True)
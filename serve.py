@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Production server: a gunicorn master forking SERVER_WORKERS worker
+processes, each serving SERVER_THREADS requests at a time.
+
+usage: python serve.py [--bind ADDRESS] [--workers N] [--threads N] [--preload]
+
+Each worker builds and warms up the application (see wsgi.py) before it
+accepts connections. ``kill -HUP <master pid>`` restarts gracefully: new
+workers load the current code, the old ones stop accepting connections and
+finish their requests within SERVER_GRACEFUL_TIMEOUT seconds.
+
+With --preload the application is built once by the master and shared by
+the workers (copy on write, less memory), but HUP then keeps running the
+old code: upgrade with USR2 (new master) followed by QUIT of the old one.
+"""
+
+import argparse
+
+from gunicorn.app.base import BaseApplication
+
+import config
+
+
+def post_fork(server, worker):
+    # only preloaded applications exist before the fork: their connections
+    # belong to the master, and the background threads did not survive it
+    if server.cfg.preload_app:
+        from app import db
+        db.dispose(server.app.wsgi())
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        BaseApplication.__init__(self)
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        # imported here, by the worker unless preloading, so that the code
+        # is loaded again when the workers are replaced
+        from wsgi import application
+        return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run microblog with gunicorn')
+    parser.add_argument('--bind', default=config.SERVER_BIND)
+    parser.add_argument('--workers', type=int, default=config.SERVER_WORKERS)
+    parser.add_argument('--threads', type=int, default=config.SERVER_THREADS)
+    parser.add_argument('--preload', action='store_true',
+        help='build the application once, in the master')
+    args = parser.parse_args()
+
+    Server({
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        # python 2 needs the futures package for the threaded workers
+        'worker_class': 'gthread' if args.threads > 1 else 'sync',
+        'timeout': config.SERVER_TIMEOUT,
+        'graceful_timeout': config.SERVER_GRACEFUL_TIMEOUT,
+        'max_requests': config.SERVER_MAX_REQUESTS,
+        # spread the restarts of the workers
+        'max_requests_jitter': config.SERVER_MAX_REQUESTS // 10,
+        'preload_app': args.preload,
+        'post_fork': post_fork,
+        'accesslog': '-',
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -8,5 +8,7 @@ from pprint import pprint
 from flask import *
 from app import *
 
+app = create_app()
+app.app_context().push()
 
 os.environ['PYTHONINSPECT'] = 'True'
@@ -0,0 +1,12 @@
+"""The WSGI application, for any WSGI server:
+
+    gunicorn --workers 4 --threads 8 wsgi:application
+
+It is warmed up before the server hands it a request.
+"""
+
+from app import create_app, warm_up
+
+
+application = create_app()
+warm_up(application)